@@ -2,11 +2,15 @@
 from application.config import LocalDevelopmentConfig
 from .instances import db, api, mail, app, cache
 from flask_jwt_extended import JWTManager
-from .models import User, Role, Products, Category, Orders, ItemsOrdered, Cart, Feedback
+from .models import User, Role, Products, Category, Orders, ItemsOrdered, Cart, Feedback, ProductPopularity, DailyOrderStats
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash
 from flask_restful import Api
 from application.workers import celery_init_app
+from application.search import create_search_index
+from application.popularity import rebuild_popularity
+from application.rollups import rebuild_rollups
+from application.metrics import init_metrics
 
 
 def create_app():
@@ -19,7 +23,13 @@ def create_app():
                 result_backend = 'redis://localhost:6379/1',
                 task_ignore_result = False,
                 broker_connection_retry_on_startup = True,
-                timezone = "Asia/kolkata"
+                timezone = "Asia/kolkata",
+                # Long running exports do not hold up the other tasks
+                task_routes = {
+                    'generate_csv': {'queue': app.config['EXPORT_QUEUE']},
+                    'generate_export_bundle': {'queue': app.config['EXPORT_QUEUE']},
+                    'application.tasks.sendMailBatch': {'queue': app.config['MAIL_QUEUE']},
+                },
         )
     )
     db.init_app(app)
@@ -35,6 +45,7 @@ def create_app():
     mail.init_app(app)
     app.app_context().push()
     cache.init_app(app)
+    init_metrics(app)
     app.app_context().push()
     with app.app_context():
         initialise_database(app)
@@ -145,3 +156,18 @@ def initialise_database(app):
             print("Database tables created.")
         else:
             print("Database tables already exist.")
+            # Creates the tables added to the models since the database was set up
+            db.create_all()
+            # And the indexes added to the existing tables
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(db.engine, checkfirst=True)
+            if 'token_version' not in [column['name'] for column in inspector.get_columns('User')]:
+                db.session.execute(db.text('ALTER TABLE "User" ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0'))
+                db.session.commit()
+        create_search_index()
+        if ProductPopularity.query.first() is None:
+            rebuild_popularity()
+        # Orders placed before the rollups existed
+        if DailyOrderStats.query.first() is None and Orders.query.first() is not None:
+            rebuild_rollups()
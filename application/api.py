@@ -1,17 +1,19 @@
 
 from flask_restful import Resource, reqparse, marshal, request, marshal_with
-from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from .instances import db, app
-from flask_jwt_extended import jwt_required, current_user, create_access_token
+from flask_jwt_extended import jwt_required, current_user
 from application.roles import admin_required, customer_required, store_manager_required, owner_required
-from application.models import User, Products, Category, ManagerRequests, Feedback, Cart
-import os
-from .utilities import getImageFromEntity, categories_resource_fields, category_parser, products_resource_fields, user_resource_fields, manager_request_resource_fields, manager_request_parser, test_api_response_fields, feedback_parser, feedback_resource_fields, feedback_resource_fields, user_fields
-from .utilities import get_all_categories, get_all_products, get_all_users, get_all_manager_requests
+from application.models import User, Products, Category, ManagerRequests, Feedback, Cart, ProductPopularity
+from .utilities import categories_resource_fields, category_parser, products_resource_fields, product_detail_resource_fields, user_resource_fields, manager_request_resource_fields, manager_request_parser, test_api_response_fields, feedback_parser, feedback_resource_fields, feedback_resource_fields, user_fields
+from .utilities import getPageArgs, get_products_page, get_categories_page, get_users_page, get_manager_requests_page, get_reviews_page, get_category_products_page
 from datetime import datetime
-from .instances import cache
-from .controllers import category_products, product_reviews
+from .tasks import create_image_variants
+from .tokens import create_user_token
+from .serializers import fast_marshal, json_response
+from .loadplans import products_load_plan
+from .rollups import forget_product_sales
+from .utils.images import store_upload
 
 
 
@@ -52,7 +54,7 @@ class SignupAPI(Resource):
 
         new_user.update_last_activity()
         serialized_user = marshal(new_user, user_resource_fields)
-        access_token = create_access_token(identity=new_user.username)
+        access_token = create_user_token(new_user)
         return {'message': 'User registered successfully', 'access_token': access_token, 'user': serialized_user}, 201
 
 class LoginAPI(Resource):
@@ -66,7 +68,7 @@ class LoginAPI(Resource):
         if user and check_password_hash(user.password, request.json['password']):
             if user.active == False:
                 return {'message': 'User is inactive. Ask admin to activate this account'}, 403
-            access_token = create_access_token(identity=user.username)
+            access_token = create_user_token(user)
             serialized_user = marshal(user, user_resource_fields)
             user.update_last_activity()
             return {'access_token': access_token, 'user': serialized_user}, 200
@@ -75,14 +77,15 @@ class LoginAPI(Resource):
 class UsersAPI(Resource):
     @jwt_required()
     def get(self, user_id = None):
-        users = get_all_users()
+        after, limit = getPageArgs()
+        users, next_cursor = get_users_page(after, limit)
         # If the user is not admin, return only the essential details otherwise return all details
         # Role id 3 is for admin
         if current_user.role_id != 3:
             serialized_users = [marshal(user, user_fields) for user in users]
         else:
             serialized_users = [marshal(user, user_resource_fields) for user in users]
-        return serialized_users, 200
+        return {'data': serialized_users, 'next_cursor': next_cursor}, 200
 
     @jwt_required()
     def put(self, user_id):
@@ -98,25 +101,23 @@ class UsersAPI(Resource):
         current_user.password = generate_password_hash(new_password)
         current_user.update_last_activity()
         db.session.commit()
-        cache.delete('all_users')
         # Generate a new access token for the user
-        access_token = create_access_token(identity=current_user.username)
+        access_token = create_user_token(current_user)
         return {'message': 'User updated successfully', 'access_token': access_token, 'user': marshal(current_user,user_resource_fields)}, 201
 
 class ProductsAPI(Resource):
     @jwt_required()
-    @cache.memoize(10)
     def get(self, product_id = None):
         if product_id is not None:
-            product = Products.query.get(product_id)
+            product = db.session.get(Products, product_id, options=products_load_plan)
             if product:
-                product.image_file = getImageFromEntity(product)
-                return marshal(product, products_resource_fields),200
+                return json_response(fast_marshal(product, product_detail_resource_fields))
             else:
                 return {'message': 'Product not found'}, 404
         else:
-            products = get_all_products()
-            return marshal(products, products_resource_fields),200
+            after, limit = getPageArgs()
+            products, next_cursor = get_products_page(after, limit)
+            return json_response({'data': products, 'next_cursor': next_cursor})
 
     @jwt_required()
     @owner_required
@@ -127,10 +128,7 @@ class ProductsAPI(Resource):
             if 'category_id' not in data:
                 data['category_id'] = 1
             if 'image' in request.files:
-                filename = secure_filename(request.files['image'].filename)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                image = request.files['image']
-                image.save(img_path)
+                filename = store_upload(request.files['image'])
             else:
                 filename = ''
             product = Products(     
@@ -151,9 +149,9 @@ class ProductsAPI(Resource):
             product.store_owner_id = current_user.id
             db.session.add(product)
             db.session.commit()
-            cache.delete_memoized(category_products, product.category_id)
-            cache.delete('all_products')
-            return marshal(product, products_resource_fields), 201
+            if product.image:
+                create_image_variants.delay(product.image, product.id)
+            return marshal(product, product_detail_resource_fields), 201
         except Exception as e:
             print("Error",e)
             return {'message': 'Error in creating product'}, 500
@@ -168,12 +166,9 @@ class ProductsAPI(Resource):
                 return {"message": "Permission denied"}, 403
             data = request.form
             # Handle image upload
-            if 'image' in request.files and request.files['image'].filename != '':
-                filename = secure_filename(request.files['image'].filename)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                image = request.files['image']
-                product.image = filename
-                image.save(img_path)
+            image_uploaded = 'image' in request.files and request.files['image'].filename != ''
+            if image_uploaded:
+                product.image = store_upload(request.files['image'])
             for key, value in data.items():
                 if key in ['title', 'description', 'price', 'category_id', 'stock', 'unit', 'manufacture_date', 'expiry_date', 'discount']:
                     if value and value!='':
@@ -182,9 +177,9 @@ class ProductsAPI(Resource):
                             value = datetime.fromisoformat(value)
                         setattr(product, key, value)
             db.session.commit()
-            cache.delete_memoized(category_products, product.category_id)
-            cache.delete('all_products')
-            return marshal(product, products_resource_fields), 201
+            if image_uploaded:
+                create_image_variants.delay(product.image, product.id)
+            return marshal(product, product_detail_resource_fields), 201
         return {'message': 'Product not found'}, 404
 
     @jwt_required()
@@ -198,26 +193,30 @@ class ProductsAPI(Resource):
         # Either store manager or admin can delete the product
         if (current_user.id != product.store_owner_id) and current_user.role_id != 3:
             return {"message": "Permission denied"}, 403
-        # Deleting all associated records in feedback, cart and orders related to this product. So that the product can be deleted.
-        for item in product.orders_placed:
-            db.session.delete(item)
-        cartItems = Cart.query.filter_by(product_id=product_id).all()
-        for item in cartItems:
-            db.session.delete(item)
-        for feedback in product.feedbacks:
-            db.session.delete(feedback)
-        db.session.delete(product)
+        deleteProduct(product)
         db.session.commit()
-        cache.delete_memoized(category_products, product.category_id)
-        cache.delete('all_products')
         return {'message': 'Product deleted successfully'}, 200
 
+# Deletes the product with its ordered items, cart items, feedback, popularity and sales rollups (not committed)
+def deleteProduct(product):
+    # Deleting all associated records in feedback, cart and orders related to this product. So that the product can be deleted.
+    for item in product.orders_placed:
+        db.session.delete(item)
+    cartItems = Cart.query.filter_by(product_id=product.id).all()
+    for item in cartItems:
+        db.session.delete(item)
+    for feedback in product.feedbacks:
+        db.session.delete(feedback)
+    ProductPopularity.query.filter_by(product_id=product.id).delete()
+    forget_product_sales(product.id)
+    db.session.delete(product)
+
 class CategoriesAPI(Resource):
     @jwt_required()
     def get(self):
-        categories = get_all_categories()
-        result = marshal(categories, categories_resource_fields), 200
-        return result
+        after, limit = getPageArgs()
+        categories, next_cursor = get_categories_page(after, limit)
+        return json_response({'data': categories, 'next_cursor': next_cursor})
 
     @jwt_required()
     @admin_required
@@ -229,7 +228,6 @@ class CategoriesAPI(Resource):
         category.owner_id = current_user.id
         db.session.add(category)
         db.session.commit()
-        cache.delete('all_categories')
         return marshal(category, categories_resource_fields), 201
 
     @jwt_required()
@@ -243,7 +241,6 @@ class CategoriesAPI(Resource):
                 if key in ['name', 'description', 'owner_id', 'approved']:
                     setattr(category, key, value)
             db.session.commit()
-            cache.delete('all_categories')
             return marshal(category, categories_resource_fields), 201
         return {'message': 'Category not found'}, 404
 
@@ -269,12 +266,9 @@ class CategoriesAPI(Resource):
             else:
                 # Delete each product individually
                 for product in products:
-                    db.session.delete(product)
+                    deleteProduct(product)
             db.session.delete(category)
             db.session.commit()
-            if not delete_products:
-                cache.delete_memoized(category_products, category_id)
-            cache.delete('all_categories')
             return {'message': 'Category deleted successfully'}, 200
         return {'message': 'Category not found'}, 404
 
@@ -292,7 +286,6 @@ class FeedbackAPI(Resource):
         current_user.update_last_activity()
         db.session.commit()
         feedback.user_id=current_user.id
-        cache.delete_memoized(product_reviews,feedback.product_id)
         return marshal(feedback, feedback_resource_fields), 201
 
     @jwt_required()
@@ -307,7 +300,6 @@ class FeedbackAPI(Resource):
             db.session.commit()
             product.compute_average_rating()
             db.session.commit()
-            cache.delete_memoized(product_reviews,feedback.product_id)
             return {'message': 'Feedback deleted successfully'}, 200
         return {'message': 'Feedback not found'}, 404
 
@@ -315,8 +307,9 @@ class ManagerRequestsAPI(Resource):
     @jwt_required()
     @admin_required
     def get(self):
-        requests = get_all_manager_requests()
-        return marshal(requests, manager_request_resource_fields), 200
+        after, limit = getPageArgs()
+        requests, next_cursor = get_manager_requests_page(after, limit)
+        return json_response({'data': requests, 'next_cursor': next_cursor})
 
     @jwt_required()
     @store_manager_required
@@ -326,7 +319,6 @@ class ManagerRequestsAPI(Resource):
         request.user_id = current_user.id
         db.session.add(request)
         db.session.commit()
-        cache.delete('all_manager_requests')
         return marshal(request, manager_request_resource_fields), 201
 
     @jwt_required()
@@ -338,7 +330,6 @@ class ManagerRequestsAPI(Resource):
             for key, value in args.items():
                 setattr(request, key, value)
             db.session.commit()
-            cache.delete('all_manager_requests')
             return marshal(request, manager_request_resource_fields), 201
         return {'message': 'Manager request not found'}, 404
 
@@ -349,6 +340,5 @@ class ManagerRequestsAPI(Resource):
         if request:
             db.session.delete(request)
             db.session.commit()
-            cache.delete('all_manager_requests')
             return {'message': 'Manager request deleted successfully'}, 200
         return {'message': 'Manager request not found'}, 404
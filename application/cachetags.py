@@ -0,0 +1,255 @@
+import hashlib
+import inspect
+import logging
+import math
+import random
+import re
+import threading
+import time
+from functools import wraps
+from types import SimpleNamespace
+from sqlalchemy import event, inspect as inspect_model
+from sqlalchemy.orm import Session
+from redis.exceptions import LockError
+from .instances import app, cache
+from .models import User, Products, Category, Feedback, ManagerRequests, Orders, ItemsOrdered
+
+# Tag based cache invalidation
+# A cached read declares the tags of the rows it depends on, e.g. 'category:{category_id}'. The current version of
+# every tag is part of its cache key, so bumping a tag version makes all the entries depending on it unreachable
+# (they expire on their own). Versions are bumped from the session events, after the change is committed.
+
+# Tags of a row of each cached model
+TAGS = {
+    Products: lambda product: ['products', f'product:{product.id}', f'category:{product.category_id}', f'user:{product.store_owner_id}:products'],
+    Category: lambda category: ['categories', f'category:{category.id}'],
+    User: lambda user: ['users', f'user:{user.id}'],
+    # Reviews are cached with their product
+    Feedback: lambda feedback: [f'product:{feedback.product_id}'],
+    ManagerRequests: lambda request: ['manager_requests'],
+    Orders: lambda order: ['orders', f'order:{order.id}', f'user:{order.customer_id}:orders'],
+    # Items are only added with their order, which bumps the orders of the customer
+    ItemsOrdered: lambda item: ['orders', f'order:{item.order_id}'],
+}
+
+# Columns no cached read depends on, changing only these does not bump any tag
+UNTRACKED = {
+    User: {'last_activity', 'delivery_details', 'password', 'token_version'},
+}
+
+
+def tag_key(tag):
+    return f'tag:{tag}'
+
+def tag_family(tag):
+    # 'user:3:orders' -> 'user:*:orders', bumped by the bulk statements that do not say which rows they change
+    family = re.sub(r':\d+(?=:|$)', ':*', tag)
+    return family if family != tag else None
+
+def tag_versions(tags):
+    keys = []
+    for tag in tags:
+        for key in (tag, tag_family(tag)):
+            if key and key not in keys:
+                keys.append(key)
+    return tuple(version or 0 for version in cache.get_many(*[tag_key(key) for key in keys]))
+
+def bump_tags(tags):
+    cache.cache.inc_many(*[tag_key(tag) for tag in tags])
+
+
+def row_tags(row):
+    return TAGS[type(row)](row)
+
+# ------------------------ Single flight ------------------------
+
+# Lock keys refreshed in the background by this process
+_refreshing = set()
+
+def _release(lock):
+    try:
+        lock.release()
+    except LockError:
+        # Expired while computing, another worker may hold it now
+        pass
+
+def single_flight(lock_key, compute, wait_for):
+    """
+    Only the worker getting the redis lock runs compute(), the others poll wait_for() until it returns the entry
+    (anything but None, so the cached values are wrapped to be cached even when they are None).
+    If it does not show up within CACHE_LOCK_TIMEOUT (e.g. the worker holding the lock died), they compute it themselves.
+    """
+    lock = cache.cache.shared_lock(lock_key, app.config['CACHE_LOCK_TIMEOUT'])
+    if lock.acquire(blocking=False):
+        try:
+            return compute()
+        finally:
+            _release(lock)
+    deadline = time.monotonic() + app.config['CACHE_LOCK_TIMEOUT']
+    while time.monotonic() < deadline:
+        time.sleep(app.config['CACHE_LOCK_POLL_INTERVAL'])
+        entry = wait_for()
+        if entry is not None:
+            return entry
+    return compute()
+
+def refresh_in_background(lock_key, compute):
+    # Runs compute() in a thread of this process, unless a worker is refreshing the key already
+    if lock_key in _refreshing:
+        return
+    _refreshing.add(lock_key)
+
+    def refresh():
+        try:
+            with app.app_context():
+                lock = cache.cache.shared_lock(lock_key, app.config['CACHE_LOCK_TIMEOUT'])
+                if lock.acquire(blocking=False):
+                    try:
+                        compute()
+                    finally:
+                        _release(lock)
+        except Exception as e:
+            logging.warning(f'Could not refresh {lock_key}: {e}')
+        finally:
+            _refreshing.discard(lock_key)
+    threading.Thread(target=refresh, name='cache-refresh', daemon=True).start()
+
+
+def cached_by_tags(*tags, timeout=None, hot=False):
+    """
+    Caches the result of the function until one of its tags is bumped. The tags are formatted with the arguments
+    of the function, e.g. @cached_by_tags('products', 'category:{category_id}').
+    A missing value is computed by a single worker, the others wait for it.
+    A hot value is kept after it expires, and served (stale) while one worker recomputes it in the background.
+    Once its tags are bumped it is recomputed right away (by a single worker), a change is never served stale.
+    It is also recomputed early, with a probability that grows as it gets close to its expiry
+    (and with the time it took to compute), so it is usually refreshed before anyone sees it expire.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        namespace = f'{fn.__module__}.{fn.__qualname__}'
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            versions = tag_versions([tag.format(**arguments.arguments) for tag in tags])
+            arguments_hash = hashlib.md5(repr(sorted(arguments.arguments.items())).encode()).hexdigest()
+            ttl = timeout or app.config['CACHE_TAGGED_TIMEOUT']
+            if hot:
+                return hot_value(namespace + ':' + arguments_hash, versions, ttl, lambda: fn(*args, **kwargs))
+            key = 'tagged:v2:' + namespace + ':' + hashlib.md5(repr((arguments_hash, versions)).encode()).hexdigest()
+            # The entry is (value,), a None result is cached too (v2, the values were cached bare before)
+            entry = cache.get(key)
+            if entry is None:
+                def compute():
+                    entry = (fn(*args, **kwargs),)
+                    cache.set(key, entry, timeout=ttl)
+                    return entry
+                entry = single_flight('lock:' + key, compute, lambda: cache.get(key))
+            return entry[0]
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+def hot_value(name, versions, ttl, fn):
+    # The entry is (tag versions, value, expires at, seconds it took to compute), kept twice as long as its ttl to be served stale
+    key = 'hot:' + name
+
+    def compute():
+        started = time.time()
+        value = fn()
+        computed = time.time()
+        entry = (versions, value, computed + ttl, computed - started)
+        cache.set(key, entry, timeout=2 * ttl)
+        return entry
+
+    def refresh():
+        # Skipped if another worker refreshed the entry since it was read
+        current = cache.get(key)
+        if current is None or current[0] != versions or current[2] == expires_at:
+            compute()
+
+    def wait_for():
+        entry = cache.get(key)
+        return entry if entry is not None and entry[0] == versions else None
+
+    entry = cache.get(key)
+    # Missing, or out of date since a change was committed
+    if entry is None or entry[0] != versions:
+        return single_flight('lock:' + key, compute, wait_for)[1]
+    entry_versions, value, expires_at, delta = entry
+    # Early expiration: refreshed once now + delta * beta * -log(random) passes the expiry. -log(random) is mostly
+    # below 1 and rarely large, so the refresh gets likelier close to the expiry and for values slow to compute.
+    if time.time() - delta * app.config['CACHE_EARLY_REFRESH_BETA'] * math.log(1 - random.random()) >= expires_at:
+        refresh_in_background('lock:' + key, refresh)
+    return value
+
+
+# ------------------------ Session events ------------------------
+
+def _pending_tags(session):
+    return session.info.setdefault('cache_tags', set())
+
+def _previous_values(row):
+    # The row as it was before the flush, so moving a product also bumps the category it left
+    state = inspect_model(row)
+    values = {}
+    for column in state.mapper.column_attrs:
+        history = state.attrs[column.key].history
+        values[column.key] = history.deleted[0] if history.deleted else state.dict.get(column.key)
+    return SimpleNamespace(**values)
+
+def _changed_columns(row):
+    state = inspect_model(row)
+    return {column.key for column in state.mapper.column_attrs if state.attrs[column.key].history.has_changes()}
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed_tags(session, flush_context):
+    tags = _pending_tags(session)
+    for row in session.new | session.deleted:
+        if type(row) in TAGS:
+            tags.update(row_tags(row))
+    for row in session.dirty:
+        if type(row) not in TAGS:
+            continue
+        changed = _changed_columns(row)
+        if not changed or changed <= UNTRACKED.get(type(row), set()):
+            continue
+        tags.update(row_tags(row))
+        tags.update(TAGS[type(row)](_previous_values(row)))
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_statement_tags(orm_execute_state):
+    # Bulk insert / update / delete statements do not go through the flush
+    if orm_execute_state.is_select or orm_execute_state.bind_mapper is None:
+        return
+    model = orm_execute_state.bind_mapper.class_
+    if model not in TAGS:
+        return
+    tags = _pending_tags(orm_execute_state.session)
+    # The statement can name the tags of the rows it changes with .execution_options(cache_tags=[...])
+    if 'cache_tags' in orm_execute_state.execution_options:
+        tags.update(orm_execute_state.execution_options['cache_tags'])
+        return
+    if orm_execute_state.is_insert:
+        rows = orm_execute_state.parameters
+        rows = [rows] if isinstance(rows, dict) else rows or []
+        try:
+            for row in rows:
+                tags.update(TAGS[model](SimpleNamespace(**row)))
+            return
+        except AttributeError:
+            pass
+    # Otherwise every row of the model may have changed
+    tags.update(TAGS[model](SimpleNamespace(**{column.key: '*' for column in inspect_model(model).column_attrs})))
+
+@event.listens_for(Session, 'after_commit')
+def _bump_committed_tags(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        bump_tags(tags)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back_tags(session):
+    session.info.pop('cache_tags', None)
@@ -22,6 +22,8 @@ class Config(object):
     CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
     CELERY_SEND_EVENTS = True
     CELERY_TRACK_STARTED = True
+    # Raise instead of logging when an endpoint runs more queries than its query_budget
+    QUERY_BUDGET_STRICT = False
 
 class LocalDevelopmentConfig(Config):
     """
@@ -41,6 +43,9 @@ class LocalDevelopmentConfig(Config):
     ##### Flask JWT Config #####
     JWT_TOKEN_LOCATION = ["headers"]
     JWT_ACCESS_TOKEN_EXPIRES=timedelta(hours=12)
+    # Local filter of the revoked tokens (checked before the redis blocklist)
+    REVOKED_TOKEN_FILTER_CAPACITY = 100000
+    REVOKED_TOKEN_FILTER_ERROR_RATE = 0.001
 
     ##### Celery Config #####
     CELERY_BROKER_URL='redis://localhost:6379/0',
@@ -56,14 +61,75 @@ class LocalDevelopmentConfig(Config):
     MAIL_USE_SSL = False
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    # Mails sent in loops are queued to the mail queue in batches, every batch is sent over one SMTP connection.
+    # MAIL_RATE_LIMIT caps the mails sent per second on a connection (None for no limit).
+    MAIL_QUEUE = 'mail'
+    MAIL_BATCH_SIZE = 50
+    MAIL_RATE_LIMIT = None
+    # A mail failing for a reason that may go away is retried after MAIL_RETRY_BACKOFF * 2^attempt seconds (with jitter)
+    MAIL_MAX_RETRIES = 5
+    MAIL_RETRY_BACKOFF = 30
+    # Google Chat reminders are posted by CHAT_WEBHOOK_CONCURRENCY threads (greenlets in the gevent worker).
+    # A failed post is retried after CHAT_WEBHOOK_BACKOFF * 2^attempt seconds, or the Retry-After of a 429.
+    # CHAT_WEBHOOK_COALESCE users are reminded in one card (None for a message per user).
+    CHAT_WEBHOOK_CONCURRENCY = 8
+    CHAT_WEBHOOK_MAX_RETRIES = 3
+    CHAT_WEBHOOK_BACKOFF = 1
+    CHAT_WEBHOOK_TIMEOUT = 10
+    CHAT_WEBHOOK_COALESCE = None
     
     UPLOAD_FOLDER= 'application/static/images/'
+    # Exports are written to a file per celery task, read EXPORT_BATCH_SIZE rows at a time and downloaded in chunks
+    EXPORT_FOLDER = 'application/static/csv/'
+    EXPORT_BATCH_SIZE = 1000
+    EXPORT_CHUNK_SIZE = 64 * 1024
+    # Seconds an export is kept for download
+    EXPORT_RETENTION = 24 * 60 * 60
+    # Celery queue of the export tasks, consumed by the workers started with wake_export_workers.sh
+    EXPORT_QUEUE = 'exports'
+
+    # Customers per task of the monthly reports
+    MONTHLY_REPORT_CHUNK_SIZE = 500
+    # Customers read at a time (in id order) when selecting the customers to remind
+    REMINDER_CHUNK_SIZE = 1000
+    # Processes rendering the PDF reports in every celery worker (None for one per CPU), the templates they load when
+    # they start and the number of PDFs a task keeps waiting to be rendered
+    PDF_RENDER_PROCESSES = None
+    PDF_TEMPLATES = ('monthlyReport.html',)
+    PDF_RENDER_MAX_PENDING = 16
+
+    # Keyset pagination of the list endpoints (?after=<cursor>&limit=)
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+
+    # Decay periods of the trending products score, a sale counts 1/e as much after one period
+    POPULARITY_PERIODS = {'24h': timedelta(hours=24), '7d': timedelta(days=7), '30d': timedelta(days=30)}
+    POPULARITY_DEFAULT_PERIOD = '7d'
+
+    # Size variants (max width, max height) generated for every uploaded image
+    IMAGE_VARIANTS = {'thumb': (320, 320), 'large': (1280, 1280)}
+
+    # Metrics of all the web and celery workers are added up in this redis database and served at /metrics
+    METRICS_REDIS_URL = "redis://localhost:6379/2"
+    # Histogram buckets (seconds) of the request latency and of the celery queue wait and run time
+    METRICS_REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    METRICS_TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
     
-    # Redis Cache
-    CACHE_TYPE = "RedisCache"
+    # Redis Cache, with a local tier in every worker (see tieredcache)
+    CACHE_TYPE = "application.tieredcache.TieredRedisCache"
     CACHE_DEFAULT_TIMEOUT = 300
     CACHE_KEY_PREFIX = "mybasket_cache"
     CACHE_REDIS_URL = "redis://localhost:6379"
     CACHE_REDIS_HOST = "localhost"
     CACHE_REDIS_PORT = 6379
-    CACHE_REDIS_PASSWORD = ""  
\ No newline at end of file
+    CACHE_REDIS_PASSWORD = ""
+    # Reads cached with cached_by_tags are invalidated when the rows they depend on change, the timeout only frees memory
+    CACHE_TAGGED_TIMEOUT = 6 * 60 * 60
+    # A value missing from the cache is computed by the worker holding its lock, the others check every poll interval
+    CACHE_LOCK_TIMEOUT = 30
+    CACHE_LOCK_POLL_INTERVAL = 0.05
+    # Above 1 hot values are refreshed earlier, below 1 later
+    CACHE_EARLY_REFRESH_BETA = 1.0
+    # Size (of the pickled values) and entry lifetime of the local tier
+    CACHE_LOCAL_MAX_BYTES = 64 * 1024 * 1024
+    CACHE_LOCAL_TIMEOUT = 300  
\ No newline at end of file
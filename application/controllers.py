@@ -1,14 +1,33 @@
 
-from application.instances import db, app, cache
-from flask import jsonify, request
+from application.instances import db, app
+from flask import jsonify, request, redirect, send_from_directory, Response
 from flask_jwt_extended import jwt_required, current_user
 from datetime import datetime, timedelta
 from flask_restful import marshal
-from application.models import User, Category, Products, Feedback, Cart, Orders, ItemsOrdered, ManagerRequests
+from application.models import User, Category, Products, Feedback, Cart, Orders, ItemsOrdered, ManagerRequests, DailyProductSales, DailyOrderStats
 from application.roles import admin_required, store_manager_required, customer_required, owner_required
-from .utilities import feedback_resource_fields, products_resource_fields, orders_resource_fields, user_resource_fields, cart_resource_fields, items_ordered_resource_fields, getImageFromEntity
-from .utilities import get_all_categories, get_all_products
-from sqlalchemy import func, or_
+from .utilities import feedback_resource_fields, products_resource_fields, orders_resource_fields, user_resource_fields, cart_resource_fields, getImageDigest, getImageUrl
+from .utilities import getPageArgs, get_orders_page, get_reviews_page, get_category_products_page, get_store_owner_products, get_order_items
+from .utilities import getDateRangeArgs, getGranularityArg, dateBucket, dateBuckets, parseDateArg, get_ordered_items_page, get_ordered_items_totals
+from sqlalchemy import func, or_, update, insert, delete
+from .search import search_index_supported, search_matches
+from .popularity import record_sales, trending_products
+from .rollups import record_order, record_status_change
+from .tokens import revoke_user_tokens
+from .metrics import render_metrics
+from .cachetags import cached_by_tags, row_tags
+from .serializers import fast_marshal, json_response
+from .querybudget import query_budget
+from .loadplans import products_load_plan, cart_load_plan
+from sqlalchemy.orm import joinedload, selectinload
+import os
+
+
+# flask_restful.abort(400, message=...) answers the resources with JSON, the plain routes get the same {'message': ...} body
+@app.errorhandler(400)
+def bad_request(error):
+    data = getattr(error, 'data', None) or {}
+    return {'message': data.get('message', error.description)}, 400
 
 
 @app.get('/user/<int:user_id>')
@@ -38,6 +57,7 @@ def report_preference():
 # ------------------------ Products ------------------------
 
 @app.get('/products/search')
+@query_budget(4)
 @jwt_required()
 def search_products():
     # type can be latest, trending, all, few, out of stock
@@ -59,9 +79,12 @@ def search_products():
         products = Products.query.order_by(Products.manufacture_date.desc())
         ordering = False
     elif type == 'trending':
-        items = ItemsOrdered.query.group_by(ItemsOrdered.item_id).order_by(db.func.count(ItemsOrdered.item_id).desc())
-        products_ids = [item.item_id for item in items]
-        products = Products.query.filter(Products.id.in_(products_ids))
+        # period can be any of POPULARITY_PERIODS (24h, 7d, 30d)
+        period = request.args.get('period', app.config['POPULARITY_DEFAULT_PERIOD'])
+        if period not in app.config['POPULARITY_PERIODS']:
+            period = app.config['POPULARITY_DEFAULT_PERIOD']
+        products = trending_products(period)
+        ordering = False
     elif type == 'popular':
         products = Products.query.order_by(Products.average_rating.desc())
         ordering = False
@@ -73,39 +96,53 @@ def search_products():
     elif type == 'all':
         products = Products.query
 
+    rank = None
     if searchTerm != '':
-        products = products.filter(or_(Products.title.contains(searchTerm), Products.description.contains(searchTerm)))
+        if search_index_supported():
+            matches = search_matches(searchTerm)
+            if matches is None:
+                return {'message': 'No products found'}, 404
+            products = products.join(matches, Products.id == matches.c.product_id)
+            rank = matches.c.rank
+            # Without an explicit sort_by the results are ordered by relevance
+            if 'sort_by' not in request.args:
+                ordering = False
+        else:
+            products = products.filter(or_(Products.title.contains(searchTerm), Products.description.contains(searchTerm)))
 
     if category_id != '':
         products = products.filter(Products.category_id == category_id)
     if ordering:
         if sortDirection == 'desc':
-            products = products.order_by(getattr(Products, sortBy).desc()).limit(limit).all()
+            products = products.order_by(getattr(Products, sortBy).desc())
         else:
-            products = products.order_by(getattr(Products, sortBy).asc()).limit(limit).all()
-    else:
-        products = products.limit(limit).all()
+            products = products.order_by(getattr(Products, sortBy).asc())
+    if rank is not None:
+        products = products.order_by(rank)
+    products = products.options(*products_load_plan).limit(limit).all()
     if len(products) == 0:
         return {'message': 'No products found'}, 404
-    return marshal(products, products_resource_fields),200
+    return json_response(fast_marshal(products, products_resource_fields))
 
 
 @app.get('/products/<int:product_id>/reviews')
+@query_budget(3)
 @jwt_required()
-@cache.memoize(20)
 def product_reviews(product_id):
-    reviews = Feedback.query.filter_by(product_id=product_id).all()
+    after, limit = getPageArgs()
+    reviews, next_cursor = get_reviews_page(product_id, after, limit)
     if reviews:
-        return marshal(reviews, feedback_resource_fields), 200
+        return json_response({'data': reviews, 'next_cursor': next_cursor})
     return {'message': 'No review found for this product'}, 404
 
 @app.get('/categories/<int:category_id>/products')
+@query_budget(3)
 @jwt_required()
-@cache.memoize(50)
 def category_products(category_id):
-    products = Products.query.filter_by(category_id=category_id).all()
+    after, limit = getPageArgs()
+    products, next_cursor = get_category_products_page(category_id, after, limit)
     if len(products)>0:
-        return marshal(products, products_resource_fields), 200
+        return json_response({'data': products, 'next_cursor': next_cursor})
     return {'message': 'No products found for this category'}, 404
 
 
@@ -117,7 +154,6 @@ def update_visibility(product_id):
     if product:
         product.visibility = not product.visibility
         db.session.commit()
-        cache.delete(f'all_products')
         return {'message': 'Product visibility updated successfully'}, 200
     return {'message': 'Product not found'}, 404
 
@@ -132,11 +168,25 @@ def update_discount(productId):
         product.discount = request.json.get('discount') 
         product.discount = min(product.discount, 100)
         db.session.commit()
-        cache.delete(f'get_product_{product.id}')
-        cache.delete_memoized(category_products, product.category_id)
         return {'message': 'Discount updated successfully'}, 200
     return {'message': 'Product not found'}, 404
 
+# ------------------------ Images ------------------------
+# Images are content addressed, so a url never changes its content and can be cached forever by clients and proxies.
+@app.get('/images/<digest>/<path:filename>')
+def product_image(digest, filename):
+    current_digest = getImageDigest(filename)
+    if current_digest is None:
+        return {'message': 'Image not found'}, 404
+    if current_digest != digest:
+        # The image was replaced, point the client to the current version. Not a 301, browsers would keep the
+        # redirect forever and the old url would stay pinned to the version current at the first redirect.
+        return redirect(getImageUrl(filename), 302)
+    response = send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename, etag=digest, max_age=31536000, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # ------------------------ Cart Management ------------------------
 @app.post('/add_to_cart/<int:product_id>/quantity/<int:quantity>')
 @jwt_required()
@@ -176,82 +226,166 @@ def remove_from_cart(product_id):
         return {'message': 'Product removed from cart successfully'}
     return {'message': 'Product not found'}, 404
 
+@app.patch('/cart')
+@jwt_required()
+@customer_required
+def update_cart():
+    # Applies a list of {product_id, quantity} operations to the cart in one transaction.
+    # Quantity 0 removes the product, otherwise the quantity is set (limited to the stock left like the other cart endpoints)
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list):
+        return {'message': 'A list of {product_id, quantity} operations is required'}, 400
+    quantities = {}
+    for operation in operations:
+        if not isinstance(operation, dict) or type(operation.get('product_id')) is not int or type(operation.get('quantity')) is not int or operation['quantity'] < 0:
+            return {'message': 'Each operation needs an integer product_id and a non negative integer quantity'}, 400
+        quantities[operation['product_id']] = operation['quantity']
+    products = {product.id: product for product in Products.query.filter(Products.id.in_(quantities.keys())).options(*products_load_plan)}
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        return {'message': 'Product not found', 'product_ids': missing}, 404
+    items_in_cart = {}
+    duplicates = []
+    # The rows left out of the operations are serialized too, their products are loaded with them
+    for item in Cart.query.filter_by(customer_id=current_user.id).options(*cart_load_plan).order_by(Cart.id):
+        if item.product_id in items_in_cart:
+            duplicates.append(item)
+        else:
+            items_in_cart[item.product_id] = item
+    # A product added more than once is merged into a single row when it is updated
+    for item in duplicates[:]:
+        if item.product_id in quantities:
+            db.session.delete(item)
+            duplicates.remove(item)
+    for product_id, quantity in quantities.items():
+        quantity = min(quantity, products[product_id].stock)
+        item = items_in_cart.get(product_id)
+        if quantity == 0:
+            if item:
+                db.session.delete(item)
+                del items_in_cart[product_id]
+        elif item:
+            item.quantity = quantity
+        else:
+            item = Cart(customer_id=current_user.id, product_id=product_id, quantity=quantity, product=products[product_id])
+            db.session.add(item)
+            items_in_cart[product_id] = item
+    db.session.flush()
+    items = sorted(list(items_in_cart.values()) + duplicates, key=lambda item: item.id)
+    result = {
+        'items': fast_marshal(items, cart_resource_fields),
+        'totalQuantity': sum(item.quantity for item in items),
+        'totalPrice': round(sum(item.quantity * item.product.price * (1-item.product.discount/100) for item in items), 2),
+    }
+    db.session.commit()
+    return json_response(result)
+
 @app.get('/my-cart')
+@query_budget(2)
 @jwt_required()
 @customer_required
 def my_cart():
-    items_in_cart = Cart.query.filter_by(customer_id=current_user.id).all()
-    return marshal(items_in_cart, cart_resource_fields)
+    items_in_cart = Cart.query.filter_by(customer_id=current_user.id).options(*cart_load_plan).all()
+    return json_response(fast_marshal(items_in_cart, cart_resource_fields))
 
 # ------------------------ Order ------------------------
 @app.post('/place-order')
 @jwt_required()
 @customer_required
 def place_order():
-    items_in_cart = Cart.query.filter_by(customer_id=current_user.id).all()
+    items_in_cart = Cart.query.filter_by(customer_id=current_user.id).options(joinedload(Cart.product)).order_by(Cart.product_id).all()
     if len(items_in_cart) == 0:
         return {'message': 'No items in cart'}, 400
-    order = Orders(customer_id=current_user.id)
-    current_user.delivery_details = request.json.get('addressDetails')
-    db.session.add(order)
-    db.session.commit()
-    for items in items_in_cart:
-        item = ItemsOrdered(order_id=order.id, item_id=items.product_id, quantity=items.quantity, price_per_quantity=items.product.price * (1-items.product.discount/100))
-        items.product.stock -= items.quantity
-        db.session.add(item)
-        db.session.delete(items)
-    db.session.commit()
-    cache.delete_memoized(track_orders)
+    # Everything below is one transaction, any failure rolls back the order, the stock and the cart
+    try:
+        order = Orders(customer_id=current_user.id)
+        current_user.delivery_details = request.json.get('addressDetails')
+        db.session.add(order)
+        db.session.flush()
+        # Stock is decremented in the database only if enough is left, so concurrent checkouts can not oversell.
+        # Products are updated in id order so concurrent orders lock them in the same order.
+        for items in items_in_cart:
+            result = db.session.execute(
+                update(Products)
+                .where(Products.id == items.product_id, Products.stock >= items.quantity)
+                .values(stock=Products.stock - items.quantity)
+                .execution_options(synchronize_session=False, cache_tags=row_tags(items.product))
+            )
+            if result.rowcount != 1:
+                db.session.rollback()
+                return {'message': f'Not enough stock for {items.product.title}'}, 409
+        db.session.execute(insert(ItemsOrdered), [
+            {'order_id': order.id, 'item_id': items.product_id, 'quantity': items.quantity, 'price_per_quantity': items.product.price * (1-items.product.discount/100)}
+            for items in items_in_cart
+        ])
+        db.session.execute(
+            delete(Cart).where(Cart.id.in_([items.id for items in items_in_cart])).execution_options(synchronize_session=False)
+        )
+        record_sales([(items.product_id, items.quantity) for items in items_in_cart], order.created_at)
+        record_order(order, [(items.product, items.quantity, items.product.price * (1-items.product.discount/100)) for items in items_in_cart])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("Error",e)
+        return {'message': 'Error in placing order'}, 500
     return {'message': 'Order placed successfully'}, 201
 
 @app.get('/track-orders/<int:user_id>')
+@query_budget(3)
 @jwt_required()
 @customer_required
-@cache.memoize(10)
 def track_orders(user_id):
     if current_user.id != user_id:
         return {'message': 'Permission denied'}, 403
-    orders = Orders.query.filter_by(customer_id=user_id).all()
-    return marshal(orders, orders_resource_fields)
+    after, limit = getPageArgs()
+    orders, next_cursor = get_orders_page(user_id, after, limit)
+    return json_response({'data': orders, 'next_cursor': next_cursor})
 
 @app.get('/manager/orders')
+@query_budget(3)
 @jwt_required()
 @owner_required
 def placed_orders():
-    if current_user.role_id == 3:
-        productsOwned = get_all_products()
-    else:
-        productsOwned = Products.query.filter_by(store_owner_id=current_user.id)
-    product_ids = [product.id for product in productsOwned]
-    itemsOrdered = ItemsOrdered.query.filter(ItemsOrdered.item_id.in_(product_ids)).all()
-    totalSales = sum([item.price_per_quantity*item.quantity for item in itemsOrdered])
-    totalQuantitiesSold = sum([item.quantity for item in itemsOrdered])
-    return {
-        'orders': marshal(itemsOrdered, items_ordered_resource_fields),
+    # Admin sees the items ordered of all the products, the store manager of the products owned
+    filters = {
+        'store_owner_id': None if current_user.role_id == 3 else current_user.id,
+        'status': request.args.get('status') or None,
+        'starting_date': parseDateArg('starting_date', None),
+        'ending_date': parseDateArg('ending_date', None, end_of_day=True),
+    }
+    if filters['status'] not in [None, 'Transit', 'Delivered', 'Cancelled', 'Pending', 'Returned']:
+        return {'message': 'Invalid status'}, 400
+    after, limit = getPageArgs()
+    items, next_cursor = get_ordered_items_page(after, limit, **filters)
+    totalSales, totalQuantitiesSold = get_ordered_items_totals(**filters)
+    return json_response({
+        'data': items,
+        'next_cursor': next_cursor,
         'totalSales': totalSales,
         'totalQuantitiesSold': totalQuantitiesSold,
-    }, 200
+    })
 
 
 @app.get('/orders/<int:order_id>/items')
+@query_budget(3)
 @jwt_required()
 @store_manager_required
-@cache.memoize(20)
 def store_manager_order_items(order_id):
-    order = Orders.query.get(order_id)
-    if (order.customer_id  == current_user.id) or current_user.role_id == 3:
-        return marshal(order.items_ordered, items_ordered_resource_fields)
+    order = get_order_items(order_id)
+    if order is None:
+        return {'message': 'Order not found'}, 404
+    customer_id, items = order
+    if (customer_id  == current_user.id) or current_user.role_id == 3:
+        return items
     return {'message': 'Permission denied'}, 403
 
 @app.get('/manager/products')
+@query_budget(2)
 @jwt_required()
 @store_manager_required
-@cache.memoize(20)
 def store_manager_products():
-    products = Products.query.filter_by(store_owner_id=current_user.id).all()
-    for product in products:
-        product.image_file = getImageFromEntity(product)
-    return marshal(products, products_resource_fields), 200
+    products = get_store_owner_products(current_user.id)
+    return json_response(fast_marshal(products, products_resource_fields))
 
 
 
@@ -265,8 +399,9 @@ def update_order_status(order_id):
     if current_user.role_id == 1:
         if (current_user.id != order.customer_id and status != 'Cancelled'):
             return {'message': 'Permission denied'}, 403
+    previous_status = order.status
     order.status = status
-    cache.delete_memoized(track_orders, order.customer_id)
+    record_status_change(order, previous_status)
     db.session.commit()
     return {'message': 'Order status updated successfully'}, 200
 
@@ -302,9 +437,6 @@ def approve_request(id):
                 db.session.commit()
             db.session.delete(category)
             db.session.commit()
-            if not delete_products:
-                cache.delete_memoized(category_products, category.id)
-            cache.delete('all_categories')
             db.session.delete(category)
             db.session.delete(request)
         elif (request.type == 'Approve Manager'):
@@ -313,11 +445,7 @@ def approve_request(id):
             db.session.delete(request)
         else:
             return {'message': 'Invalid request type'}, 400
-        cache.delete(f'all_manager_requests')
         db.session.commit()
-        if 'Category' in request.type:
-            cache.delete(f'get_categories_')
-            cache.delete(f'get_categories_{request.relatedId}')
         return {'message': 'Request approved successfully'}
     except Exception as e:
         print("Error",e)
@@ -331,7 +459,6 @@ def decline_request(id):
     try :
         db.session.delete(request)
         db.session.commit()
-        cache.delete(f'all_manager_requests')
         return {'message': 'Request removed successfully'}
     except :
         return {'message': 'Request not found'}, 404
@@ -340,7 +467,7 @@ def decline_request(id):
 @app.post('/deactivate/<int:id>')
 @jwt_required()
 def deactivate(id):
-    if current_user.role.id != 3 and current_user.id != id:
+    if current_user.role_id != 3 and current_user.id != id:
         return {"message": "Permission denied"}, 403
     user = User.query.get(id)
     if user:
@@ -348,7 +475,7 @@ def deactivate(id):
             return {"message": "Cannot deactivate admin account"}, 403
         user.active = False
         db.session.commit()
-        cache.delete('all_users')
+        revoke_user_tokens(user)
         return {'message': 'Account deactivated successfully'}
     return {'message': 'Account not found'}, 404
 
@@ -361,7 +488,6 @@ def reactivate(id):
         if user.role_id == 3:
             return {"message": "Cannot reactivate admin account"}, 403
         user.active = True
-        cache.delete('all_users')
         db.session.commit()
         return {'message': 'Account reactivated successfully'}
     return {'message': 'Account not found'}, 404
@@ -370,94 +496,115 @@ def reactivate(id):
 @app.get('/summary/items-sold')
 @jwt_required()
 @store_manager_required
-@cache.cached(timeout=20, key_prefix='items_sold')
 def summary_items_sold():
-    now = datetime.utcnow()
+    return jsonify(items_sold_summary(current_user.id, datetime.utcnow().date())),200
+
+# Keyed by the day, so the 7 days window moves at midnight
+@cached_by_tags('orders', 'user:{store_owner_id}:products', hot=True)
+def items_sold_summary(store_owner_id, today):
     # Create a list of dates for the past 7 days
-    dates = [(now - timedelta(days=i)).date() for i in range(7)]
-    items_data={}
-    productsOwnedIds = [product.id for product in Products.query.filter_by(store_owner_id=current_user.id).all()]
-    productTitle = [product.title for product in Products.query.filter_by(store_owner_id=current_user.id).all()]
+    dates = [today - timedelta(days=i) for i in range(7)]
+    # One read of the daily rollups, products without sales in the week come with a NULL date
+    rows = db.session.query(Products.title, DailyProductSales.date, DailyProductSales.quantity).outerjoin(
+        DailyProductSales,
+        (DailyProductSales.product_id == Products.id) & DailyProductSales.date.between(dates[-1], today)
+    ).filter(Products.store_owner_id == store_owner_id).all()
+    items_data = {}
     for date in dates:
-        orders = Orders.query.filter(Orders.created_at >= date, Orders.created_at < date + timedelta(days=1)).all()
-        items_data[date.isoformat()] = {}
-        count = 0
-        for title in productTitle:
-            items_data[date.isoformat()][title] = 0
-        for order in orders:
-            for item in order.items_ordered:
-                if item.item_id not in productsOwnedIds:
-                    continue
-                items_data[date.isoformat()][item.item.title] += item.quantity
-                count += item.quantity
-            items_data[date.isoformat()]['total'] = count
-        if (len(orders)==0):
-            items_data[date.isoformat()]['total'] = 0
-    return jsonify(items_data),200
+        items_data[date.isoformat()] = {title: 0 for title, _, _ in rows}
+        items_data[date.isoformat()]['total'] = 0
+    for title, date, quantity in rows:
+        if date is None:
+            continue
+        items_data[date.isoformat()][title] += quantity
+        items_data[date.isoformat()]['total'] += quantity
+    return items_data
 
 # ------------------------ Admin Dashboard ------------------------
 @app.get('/summary/orders-placed')
 @jwt_required()
 @admin_required
-@cache.cached(timeout=20, key_prefix='orders_placed')
 def summary_order_placed():
-    product_ids = [product.id for product in get_all_products()]
-    itemsOrdered = ItemsOrdered.query.filter(ItemsOrdered.item_id.in_(product_ids)).all()
-    totalSales = sum([item.price_per_quantity*item.quantity for item in itemsOrdered])
-    totalQuantitiesSold = sum([item.quantity for item in itemsOrdered])
-    now = datetime.utcnow()
-    # Create a list of dates for the past 7 days
-    dates = [(now - timedelta(days=i)).date() for i in range(7)]
-    orders_data={}
-    for date in dates:
-        count = Orders.query.filter(Orders.created_at >= date, Orders.created_at < date + timedelta(days=1)).count()
-        orders_data[date.isoformat()] = count
-    order_status_data = {}
-    for status in ['Transit', 'Delivered', 'Cancelled', 'Pending', 'Returned']:
-        order_status_data[status] = Orders.query.filter_by(status=status).count()
-    return jsonify({'orders':orders_data, 'status':order_status_data,'totalSales': totalSales,'totalQuantitiesSold': totalQuantitiesSold,}),200
+    return jsonify(orders_placed_summary(datetime.utcnow().date())),200
 
+@cached_by_tags('orders', 'products', hot=True)
+def orders_placed_summary(today):
+    totalSales, totalQuantitiesSold = db.session.query(
+        func.coalesce(func.sum(DailyProductSales.revenue), 0), func.coalesce(func.sum(DailyProductSales.quantity), 0)
+    ).one()
+    # Create a list of dates for the past 7 days
+    dates = [today - timedelta(days=i) for i in range(7)]
+    orders_data = {date.isoformat(): 0 for date in dates}
+    order_status_data = {status: 0 for status in ['Transit', 'Delivered', 'Cancelled', 'Pending', 'Returned']}
+    # Orders by day and status, the week is summed per day and every day per status
+    for date, status, count in db.session.query(DailyOrderStats.date, DailyOrderStats.status, DailyOrderStats.orders):
+        if date.isoformat() in orders_data:
+            orders_data[date.isoformat()] += count
+        order_status_data[status] += count
+    return {'orders':orders_data, 'status':order_status_data,'totalSales': totalSales,'totalQuantitiesSold': totalQuantitiesSold,}
 
 @app.get('/summary/categories')
 @jwt_required()
 @owner_required
 def summary_category_products():
-    category_product_count_dict = {}
-    starting_date = request.args.get('starting_date', datetime.utcnow() - timedelta(days=7))
-    ending_date = request.args.get('ending_date', datetime.utcnow())
-    categories = get_all_categories()
-    for category in categories:
-        query = Products.query.filter_by(category_id=category.id).filter(
-            Products.manufacture_date >= starting_date, Products.manufacture_date <= ending_date
-        )
-        # Filter the summary data for the store manager. Showing only the products owned by the store manager. For admin it shows all the products.
-        if current_user.role_id == 2:
-            query = query.filter_by(store_owner_id=current_user.id)
-        category_product_count_dict[category.name] = query.count()
-    return category_product_count_dict, 200
+    starting_date, ending_date = getDateRangeArgs()
+    granularity = getGranularityArg()
+    # Products per category (and per time bucket) counted in one grouped query, categories without products included
+    products = db.select(Products.category_id, func.count().label('count')).where(
+        Products.manufacture_date >= starting_date, Products.manufacture_date <= ending_date
+    ).group_by(Products.category_id)
+    # Filter the summary data for the store manager. Showing only the products owned by the store manager. For admin it shows all the products.
+    if current_user.role_id == 2:
+        products = products.where(Products.store_owner_id == current_user.id)
+    if granularity:
+        bucket = dateBucket(Products.manufacture_date, granularity)
+        products = products.add_columns(bucket.label('bucket')).group_by(bucket)
+    products = products.subquery()
+    columns = [Category.name, func.coalesce(products.c['count'], 0)]
+    if granularity:
+        columns.append(products.c.bucket)
+    rows = db.session.query(*columns).outerjoin(products, products.c.category_id == Category.id).all()
+    return groupSummary(rows, starting_date, ending_date, granularity), 200
 
 @app.get('/summary/sales')
 @jwt_required()
 def summary():
-    if current_user.role_id == 3:
-        productsOwned = get_all_products()
-    elif current_user.role_id == 2:
-        productsOwned = Products.query.filter_by(store_owner_id=current_user.id).all()
-    else:
+    if current_user.role_id not in [2, 3]:
         return {"message": "Permission denied"}, 403
-    sold_count_dict = {}
-    starting_date = request.args.get('starting_date', datetime.utcnow() - timedelta(days=7))
-    ending_date = request.args.get('ending_date', datetime.utcnow())
-    eligible_order_ids = [
-        order_id for order_id, in (
-            db.session.query(Orders.id)
-            .filter(Orders.created_at >= starting_date, Orders.created_at <= ending_date)
-            .all()
-        )
-    ]
-    for product in productsOwned:
-        sold_count_dict[product.title] = ItemsOrdered.query.filter(
-            ItemsOrdered.item_id == product.id,
-            ItemsOrdered.order_id.in_(eligible_order_ids)
-        ).with_entities(func.sum(ItemsOrdered.quantity)).scalar()
-    return jsonify(sold_count_dict), 200
+    starting_date, ending_date = getDateRangeArgs()
+    granularity = getGranularityArg()
+    # Quantities sold per product (and per time bucket) summed in one grouped query, products not sold included
+    sales = db.select(ItemsOrdered.item_id, func.sum(ItemsOrdered.quantity).label('quantity')).join(
+        Orders, Orders.id == ItemsOrdered.order_id
+    ).where(Orders.created_at >= starting_date, Orders.created_at <= ending_date).group_by(ItemsOrdered.item_id)
+    if granularity:
+        bucket = dateBucket(Orders.created_at, granularity)
+        sales = sales.add_columns(bucket.label('bucket')).group_by(bucket)
+    sales = sales.subquery()
+    columns = [Products.title, func.coalesce(sales.c.quantity, 0)]
+    if granularity:
+        columns.append(sales.c.bucket)
+    query = db.session.query(*columns).outerjoin(sales, sales.c.item_id == Products.id)
+    # Admin sees all the products, the store manager only the products owned
+    if current_user.role_id == 2:
+        query = query.filter(Products.store_owner_id == current_user.id)
+    return jsonify(groupSummary(query.all(), starting_date, ending_date, granularity)), 200
+
+# It builds {name: value} from the (name, value) rows, or {name: {bucket: value}} with every bucket of the range from the (name, value, bucket) rows
+def groupSummary(rows, starting_date, ending_date, granularity):
+    if not granularity:
+        return {name: value for name, value in rows}
+    buckets = dateBuckets(starting_date, ending_date, granularity)
+    summary = {}
+    for name, value, bucket in rows:
+        series = summary.setdefault(name, dict.fromkeys(buckets, 0))
+        if bucket is not None:
+            series[bucket] = series.get(bucket, 0) + value
+    return summary
+
+# ------------------------ Metrics ------------------------
+
+@app.get('/metrics')
+def metrics():
+    # Prometheus text format, added up over all the web and celery workers
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
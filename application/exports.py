@@ -0,0 +1,173 @@
+import csv
+import gzip
+import io
+import os
+import time
+import zipfile
+from sqlalchemy import func
+from .instances import db, app
+from .models import Products, Category, Orders, ItemsOrdered, Feedback, User
+from .utilities import ordered_items_query
+
+# Exports are streamed from the database to a file of their own (named after the celery task), batch by batch,
+# so neither the rows nor the file are ever held in memory, and concurrent exports do not overwrite each other.
+
+PRODUCTS_HEADER = [
+    'ID', 'Title', 'Description', 'MRP', 'Discount %', 'Discounted Price', 'Unit (measured in)', 'Initial Stock',
+    'Stock Left', 'Items Sold', 'Manufacture Date', 'Expiry Date', 'Category', 'Average Rating',
+    'Visibility to customers (Ask admin for toggling this on/off)',
+]
+
+def products_statement(manager_id):
+    return db.select(
+        Products.id, Products.title, Products.description, Products.price, Products.discount, Products.unit,
+        Products.initialStock, Products.stock, Products.manufacture_date, Products.expiry_date,
+        Category.name.label('category'), Products.average_rating, Products.visibility,
+    ).outerjoin(Category, Category.id == Products.category_id).where(Products.store_owner_id == manager_id).order_by(Products.id)
+
+def product_row(product):
+    return [
+        product.id, product.title, product.description, product.price, product.discount,
+        product.price * (1 - product.discount / 100), product.unit, product.initialStock, product.stock,
+        product.initialStock - product.stock, product.manufacture_date, product.expiry_date, product.category,
+        'No ratings yet' if product.average_rating == 0.0 else product.average_rating,
+        'Yes' if product.visibility else 'No',
+    ]
+
+# The bundle datasets cover the products of the store owner, the orders, items and feedback within the date range (if any)
+ORDERS_HEADER = ['Order ID', 'Customer', 'Status', 'Placed On', 'Updated On', 'Items', 'Quantity', 'Total']
+
+def orders_statement(manager_id, starting_date=None, ending_date=None):
+    # Orders with at least one product of the store owner, with the totals of those products only.
+    # Every column that is not a total is grouped by, so the query also runs on the databases enforcing it (PostgreSQL)
+    return ordered_items_query(
+        Orders.id, User.username, Orders.status, Orders.created_at, Orders.updated_at, func.count(ItemsOrdered.id),
+        func.sum(ItemsOrdered.quantity), func.sum(ItemsOrdered.quantity * ItemsOrdered.price_per_quantity),
+        store_owner_id=manager_id, starting_date=starting_date, ending_date=ending_date,
+    ).join(User, User.id == Orders.customer_id).group_by(
+        Orders.id, User.username, Orders.status, Orders.created_at, Orders.updated_at
+    ).order_by(Orders.id).statement
+
+ITEMS_HEADER = ['ID', 'Order ID', 'Product ID', 'Title', 'Quantity', 'Price Per Quantity', 'Order Status', 'Placed On']
+
+def items_statement(manager_id, starting_date=None, ending_date=None):
+    return ordered_items_query(
+        ItemsOrdered.id, ItemsOrdered.order_id, ItemsOrdered.item_id, Products.title, ItemsOrdered.quantity,
+        ItemsOrdered.price_per_quantity, Orders.status, Orders.created_at,
+        store_owner_id=manager_id, starting_date=starting_date, ending_date=ending_date,
+    ).order_by(ItemsOrdered.id).statement
+
+FEEDBACK_HEADER = ['ID', 'Product ID', 'Title', 'Customer', 'Rating', 'Review', 'Created On']
+
+def feedback_statement(manager_id, starting_date=None, ending_date=None):
+    statement = db.select(
+        Feedback.id, Feedback.product_id, Products.title, User.username, Feedback.rating, Feedback.review, Feedback.created_at,
+    ).join(Products, Products.id == Feedback.product_id).join(User, User.id == Feedback.user_id).where(
+        Products.store_owner_id == manager_id
+    ).order_by(Feedback.id)
+    if starting_date is not None:
+        statement = statement.where(Feedback.created_at >= starting_date)
+    if ending_date is not None:
+        statement = statement.where(Feedback.created_at <= ending_date)
+    return statement
+
+# (file name, header, statement(manager_id, starting_date, ending_date), row formatter or None for the plain row)
+BUNDLE = [
+    ('products.csv', PRODUCTS_HEADER, lambda manager_id, starting_date, ending_date: products_statement(manager_id), product_row),
+    ('orders.csv', ORDERS_HEADER, orders_statement, None),
+    ('items_ordered.csv', ITEMS_HEADER, items_statement, None),
+    ('feedback.csv', FEEDBACK_HEADER, feedback_statement, None),
+]
+
+
+
+def export_path(filename):
+    return os.path.join(app.config['EXPORT_FOLDER'], filename)
+
+def remove_expired_exports():
+    # Exports are downloaded once, they are kept for EXPORT_RETENTION seconds
+    folder = app.config['EXPORT_FOLDER']
+    expired = time.time() - app.config['EXPORT_RETENTION']
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.endswith(('.csv', '.csv.gz', '.zip', '.part')) and os.path.getmtime(path) < expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def write_csv(file, header, statement, row, progress=None):
+    """
+    Writes the header and the rows of the statement, formatted by row() if given, to the (text) file.
+    Rows are fetched EXPORT_BATCH_SIZE at a time, progress(done, total) is called at most once a second.
+    Returns the number of rows written.
+    """
+    total = db.session.scalar(db.select(func.count()).select_from(statement.subquery())) if progress else None
+    writer = csv.writer(file)
+    writer.writerow(header)
+    done = 0
+    reported = time.monotonic()
+    result = db.session.execute(statement.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']))
+    for batch in result.partitions():
+        writer.writerows(batch if row is None else (row(item) for item in batch))
+        done += len(batch)
+        if progress and time.monotonic() - reported >= 1:
+            progress(done, total)
+            reported = time.monotonic()
+    return done
+
+def write_export(path, write):
+    # Written under a temporary name and renamed once complete, so a partial export is never served
+    part = path + '.part'
+    try:
+        result = write(part)
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return result
+
+def export_products_csv(manager_id, task_id, compress=False, progress=None):
+    remove_expired_exports()
+    filename = f'{task_id}.csv.gz' if compress else f'{task_id}.csv'
+
+    def write(part):
+        with (gzip.open(part, 'wt', newline='') if compress else open(part, 'w', newline='')) as file:
+            return write_csv(file, PRODUCTS_HEADER, products_statement(manager_id), product_row, progress)
+    rows = write_export(export_path(filename), write)
+    return {
+        'file': filename, 'rows': rows,
+        'download_name': 'exported_data.csv.gz' if compress else 'exported_data.csv',
+        'mimetype': 'application/gzip' if compress else 'text/csv',
+    }
+
+def export_bundle(manager_id, task_id, starting_date=None, ending_date=None, progress=None):
+    """
+    Writes every dataset of BUNDLE as a CSV file of a ZIP archive. Every file is compressed into the archive as its
+    rows are fetched, nothing is written to a temporary file first. progress(file name, done, total) is called while writing.
+    """
+    remove_expired_exports()
+    filename = f'{task_id}.zip'
+
+    def write(part):
+        rows = {}
+        with zipfile.ZipFile(part, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, header, statement, row in BUNDLE:
+                with archive.open(name, 'w', force_zip64=True) as member, io.TextIOWrapper(member, encoding='utf-8', newline='') as file:
+                    rows[name] = write_csv(
+                        file, header, statement(manager_id, starting_date, ending_date), row,
+                        progress and (lambda done, total: progress(name, done, total)),
+                    )
+        return rows
+    rows = write_export(export_path(filename), write)
+    return {'file': filename, 'rows': rows, 'download_name': 'exported_data.zip', 'mimetype': 'application/zip'}
+
+def stream_file(path, chunk_size):
+    # Yields the file chunk_size bytes at a time. It runs after the view returned, outside of the app context.
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
@@ -0,0 +1,33 @@
+from sqlalchemy.orm import joinedload, selectinload
+from .models import Products, Category, ManagerRequests, Feedback, Cart, Orders, ItemsOrdered
+
+# Load plans
+# Relationships are lazy by default. Every query whose rows are serialized passes the load plan of the resource fields
+# it is serialized with (see utilities), so the nested fields are loaded with the rows instead of one query per row.
+
+# products_resource_fields / product_detail_resource_fields
+products_load_plan = (joinedload(Products.store_owner),)
+
+# categories_resource_fields
+categories_load_plan = (joinedload(Category.owner),)
+
+# manager_request_resource_fields
+manager_requests_load_plan = (joinedload(ManagerRequests.user),)
+
+# feedback_resource_fields
+feedback_load_plan = (joinedload(Feedback.user),)
+
+# cart_resource_fields
+cart_load_plan = (joinedload(Cart.product).joinedload(Products.store_owner),)
+
+# items_ordered_resource_fields
+items_ordered_load_plan = (
+    joinedload(ItemsOrdered.item),
+    joinedload(ItemsOrdered.order).joinedload(Orders.customer),
+)
+
+# orders_resource_fields (item.order is the parent order, it is taken from the session without a query)
+orders_load_plan = (
+    joinedload(Orders.customer),
+    selectinload(Orders.items_ordered).joinedload(ItemsOrdered.item),
+)
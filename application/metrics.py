@@ -0,0 +1,192 @@
+import logging
+import time
+from contextvars import ContextVar
+import redis
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Metrics of the requests and the celery tasks, exposed at /metrics in the Prometheus text format.
+# Every process (web workers, celery workers) adds its measurements to the same redis hashes with
+# HINCRBY/HINCRBYFLOAT, so a scrape of any web worker returns the totals of all of them.
+
+PREFIX = 'metrics:'
+
+# name: (kind, description, labels)
+METRICS = {
+    'mybasket_http_requests_total': ('counter', 'HTTP requests handled', ('endpoint', 'method', 'status')),
+    'mybasket_http_request_duration_seconds': ('histogram', 'Time spent handling the request', ('endpoint',)),
+    'mybasket_sql_queries_total': ('counter', 'SQL statements executed', ('scope',)),
+    'mybasket_sql_duration_seconds_total': ('counter', 'Time spent executing SQL statements', ('scope',)),
+    'mybasket_cache_requests_total': ('counter', 'Cache lookups of the cached values, per tier (local, redis)', ('scope', 'tier', 'result')),
+    'mybasket_celery_tasks_total': ('counter', 'Celery tasks run', ('task', 'state')),
+    'mybasket_celery_task_queue_wait_seconds': ('histogram', 'Time between publishing the task and a worker starting it', ('task',)),
+    'mybasket_celery_task_run_seconds': ('histogram', 'Time spent running the task', ('task',)),
+}
+
+metrics_redis = None
+buckets = {}
+
+# Measurements of the request or task running in the current context
+_current = ContextVar('metrics', default=None)
+
+
+def new_measurements():
+    return {'queries': 0, 'sql_seconds': 0.0, 'cache': {}}
+
+def label_string(names, values):
+    values = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values]
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def record(pipe, scope, measurements):
+    # Adds the SQL and cache measurements of a request or task to the pipeline
+    labels = label_string(('scope',), (scope,))
+    pipe.hincrby(PREFIX + 'mybasket_sql_queries_total', labels, measurements['queries'])
+    pipe.hincrbyfloat(PREFIX + 'mybasket_sql_duration_seconds_total', labels, measurements['sql_seconds'])
+    for (tier, result), count in measurements['cache'].items():
+        pipe.hincrby(PREFIX + 'mybasket_cache_requests_total', label_string(('scope', 'tier', 'result'), (scope, tier, result)), count)
+
+def observe(pipe, name, labels, value):
+    # Histogram buckets are stored as they are observed and made cumulative when rendered
+    le = next((str(bound) for bound in buckets[name] if value <= bound), '+Inf')
+    pipe.hincrby(PREFIX + name + '_bucket', f'{labels}|{le}', 1)
+    pipe.hincrbyfloat(PREFIX + name + '_sum', labels, value)
+    pipe.hincrby(PREFIX + name + '_count', labels, 1)
+
+def send(pipe):
+    # Metrics are best effort, redis being down must not fail the request or the task
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        logging.warning(f'Could not record metrics: {e}')
+
+
+# ------------------------ SQL ------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    measurements = _current.get()
+    if measurements is not None and context is not None and hasattr(context, '_metrics_start'):
+        measurements['queries'] += 1
+        measurements['sql_seconds'] += time.perf_counter() - context._metrics_start
+
+
+# ------------------------ Cache ------------------------
+
+def count_cache_lookup(tier, hit):
+    # Called by the cache backend for every cached value looked up in a tier
+    measurements = _current.get()
+    if measurements is not None:
+        key = (tier, 'hit' if hit else 'miss')
+        measurements['cache'][key] = measurements['cache'].get(key, 0) + 1
+
+
+# ------------------------ Requests ------------------------
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_token = _current.set(new_measurements())
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+def _teardown_request(exc):
+    # Runs for every request, also the ones that raised before a response was made (counted as 500)
+    if 'metrics_start' not in g:
+        return
+    elapsed = time.perf_counter() - g.metrics_start
+    measurements = _current.get()
+    _current.reset(g.pop('metrics_token'))
+    del g.metrics_start
+    status = 500 if exc is not None else g.pop('metrics_status', 500)
+    endpoint = request.endpoint or 'unmatched'
+    pipe = metrics_redis.pipeline(transaction=False)
+    pipe.hincrby(PREFIX + 'mybasket_http_requests_total', label_string(('endpoint', 'method', 'status'), (endpoint, request.method, status)), 1)
+    observe(pipe, 'mybasket_http_request_duration_seconds', label_string(('endpoint',), (endpoint,)), elapsed)
+    record(pipe, endpoint, measurements)
+    send(pipe)
+
+
+# ------------------------ Celery ------------------------
+
+# task id: (start time, context token, queue wait) of the tasks running in this process
+_running_tasks = {}
+
+@before_task_publish.connect
+def _task_published(headers=None, **kwargs):
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+@task_prerun.connect
+def _task_started(task_id=None, task=None, **kwargs):
+    published_at = getattr(task.request, 'published_at', None)
+    # A task with an eta or countdown waits on purpose, its queue wait is not measured
+    wait = None if published_at is None or task.request.eta else max(time.time() - published_at, 0)
+    _running_tasks[task_id] = (time.perf_counter(), _current.set(new_measurements()), wait)
+
+@task_postrun.connect
+def _task_finished(task_id=None, task=None, state=None, **kwargs):
+    if task_id not in _running_tasks or metrics_redis is None:
+        return
+    start, token, wait = _running_tasks.pop(task_id)
+    elapsed = time.perf_counter() - start
+    measurements = _current.get()
+    _current.reset(token)
+    labels = label_string(('task',), (task.name,))
+    pipe = metrics_redis.pipeline(transaction=False)
+    pipe.hincrby(PREFIX + 'mybasket_celery_tasks_total', label_string(('task', 'state'), (task.name, state)), 1)
+    observe(pipe, 'mybasket_celery_task_run_seconds', labels, elapsed)
+    if wait is not None:
+        observe(pipe, 'mybasket_celery_task_queue_wait_seconds', labels, wait)
+    record(pipe, f'task:{task.name}', measurements)
+    send(pipe)
+
+
+# ------------------------ Exposition ------------------------
+
+def render_metrics():
+    pipe = metrics_redis.pipeline(transaction=False)
+    for name, (kind, description, _) in METRICS.items():
+        if kind == 'histogram':
+            pipe.hgetall(PREFIX + name + '_bucket')
+            pipe.hgetall(PREFIX + name + '_sum')
+            pipe.hgetall(PREFIX + name + '_count')
+        else:
+            pipe.hgetall(PREFIX + name)
+    values = iter(pipe.execute())
+    lines = []
+    for name, (kind, description, _) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            observed, sums, counts = next(values), next(values), next(values)
+            for labels in sorted(counts):
+                total = 0
+                for le in [str(bound) for bound in buckets[name]] + ['+Inf']:
+                    total += int(observed.get(f'{labels}|{le}', 0))
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {total}')
+                lines.append(f'{name}_sum{{{labels}}} {float(sums.get(labels, 0))}')
+                lines.append(f'{name}_count{{{labels}}} {int(counts[labels])}')
+        else:
+            for labels, value in sorted(next(values).items()):
+                lines.append(f'{name}{{{labels}}} {float(value) if "." in value else int(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app):
+    global metrics_redis
+    metrics_redis = redis.StrictRedis.from_url(app.config['METRICS_REDIS_URL'], decode_responses=True)
+    buckets['mybasket_http_request_duration_seconds'] = app.config['METRICS_REQUEST_BUCKETS']
+    buckets['mybasket_celery_task_queue_wait_seconds'] = app.config['METRICS_TASK_BUCKETS']
+    buckets['mybasket_celery_task_run_seconds'] = app.config['METRICS_TASK_BUCKETS']
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -21,9 +21,17 @@ class User(db.Model):
     approved = db.Column(db.Boolean, nullable=False, default=False)
     # For deactivating account
     active = db.Column(db.Boolean, nullable=False, default=True)
+    # Incremented to invalidate the access tokens issued to the user (see application.tokens)
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     role_id = db.Column(db.Integer, db.ForeignKey('Role.id'), nullable=False, default=1)
-    role = db.relationship('Role', backref='users', lazy='subquery')
+    role = db.relationship('Role', backref='users')
+    # Daily reminders: the customers are read by id through ix_User_role_id (the index entries of a role are in id order),
+    # a composite (role_id, last_activity) index would make SQLite sort every chunk instead
+    __table_args__ = (
+        db.Index('ix_User_role_id', 'role_id'),
+        db.Index('ix_User_last_activity', 'last_activity'),
+    )
 
     def update_last_activity(self):
         self.last_activity = datetime.utcnow()
@@ -44,7 +52,7 @@ class Category(db.Model):
     description = db.Column(db.Text)
     owner_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     approved = db.Column(db.Boolean, nullable=False, default=False)
-    owner = db.relationship('User', foreign_keys=[owner_id], lazy='subquery')
+    owner = db.relationship('User', foreign_keys=[owner_id])
 
 
 class Feedback(db.Model):
@@ -56,8 +64,8 @@ class Feedback(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('Products.id'), nullable=False)
-    user = db.relationship('User', backref='feedbacks_given', foreign_keys=[user_id], lazy='subquery')
-    product = db.relationship('Products', backref='feedbacks', foreign_keys=[product_id], lazy='subquery')
+    user = db.relationship('User', backref='feedbacks_given', foreign_keys=[user_id])
+    product = db.relationship('Products', backref='feedbacks', foreign_keys=[product_id])
 
 class ManagerRequests(db.Model):
     __tablename__ = 'ManagerRequests'
@@ -70,7 +78,7 @@ class ManagerRequests(db.Model):
     # Stores category id or store owner id based on the request type
     relatedId = db.Column(db.Integer)
     approved = db.Column(db.Boolean, nullable=False, default=False)
-    user = db.relationship('User', foreign_keys=[user_id], lazy='subquery')
+    user = db.relationship('User', foreign_keys=[user_id])
 
 
 class Products(db.Model):
@@ -98,8 +106,8 @@ class Products(db.Model):
     average_rating = db.Column(db.Float, nullable=False, default=0)
     store_owner_id = db.Column(db.Integer, db.ForeignKey('User.id'),  nullable=False)
     category_id = db.Column(db.Integer,  db.ForeignKey('Category.id'), default = 1)
-    store_owner = db.relationship('User', foreign_keys=[store_owner_id], lazy='subquery')
-    category = db.relationship('Category', backref='products', lazy='subquery')
+    store_owner = db.relationship('User', foreign_keys=[store_owner_id])
+    category = db.relationship('Category', backref='products')
 
     
     def compute_average_rating(self):
@@ -121,7 +129,7 @@ class Cart(db.Model):
     customer_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('Products.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    product = db.relationship('Products',foreign_keys=[product_id], lazy='subquery')
+    product = db.relationship('Products',foreign_keys=[product_id])
 
 # Think it like a basket
 class Orders(db.Model):
@@ -133,7 +141,12 @@ class Orders(db.Model):
     status = db.Column(db.Enum('Transit', 'Delivered', 'Cancelled', 'Pending', 'Returned'), default='Transit', nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    customer = db.relationship('User', backref='my_orders', foreign_keys=[customer_id], lazy='subquery')
+    customer = db.relationship('User', backref='my_orders', foreign_keys=[customer_id])
+    # Orders of a customer by date (order history, monthly reports, daily reminders) and orders by date (monthly reports)
+    __table_args__ = (
+        db.Index('ix_Orders_customer_id_created_at', 'customer_id', 'created_at'),
+        db.Index('ix_Orders_created_at', 'created_at'),
+    )
 
 class ItemsOrdered(db.Model):
     __tablename__ = 'ItemsOrdered'
@@ -143,5 +156,48 @@ class ItemsOrdered(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('Products.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price_per_quantity = db.Column(db.Float, nullable=False)
-    order = db.relationship('Orders', backref='items_ordered', lazy='subquery')
-    item = db.relationship('Products', backref='orders_placed', lazy='subquery')
\ No newline at end of file
+    order = db.relationship('Orders', backref='items_ordered')
+    item = db.relationship('Products', backref='orders_placed')
+    __table_args__ = (
+        # Items of an order, and the items ordered of a product newest first (manager orders feed)
+        db.Index('ix_ItemsOrdered_order_id', 'order_id'),
+        db.Index('ix_ItemsOrdered_item_id_id', 'item_id', 'id'),
+    )
+
+# Read model for trending products. One row per product and period with the exponentially decayed quantity sold.
+# The score is stored in log space relative to a fixed epoch, so rows updated at different times stay comparable
+# and the top products of a period are read straight from the (period, score) index.
+class ProductPopularity(db.Model):
+    __tablename__ = 'ProductPopularity'
+    __table_args__ = (db.Index('ix_ProductPopularity_period_score', 'period', 'score'),)
+
+    product_id = db.Column(db.Integer, db.ForeignKey('Products.id', ondelete='CASCADE'), primary_key=True)
+    # Name of the decay period (keys of POPULARITY_PERIODS in the config)
+    period = db.Column(db.String(16), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+# Daily rollups of the orders for the dashboards, kept up to date in the transactions placing orders and changing
+# their status (see rollups). Sales are keyed by the day the order was placed, with the owner and category of the
+# product at that time, so a dashboard reads a date range from one index instead of walking the orders.
+class DailyProductSales(db.Model):
+    __tablename__ = 'DailyProductSales'
+    __table_args__ = (
+        db.Index('ix_DailyProductSales_store_owner_date', 'store_owner_id', 'date'),
+        db.Index('ix_DailyProductSales_category_date', 'category_id', 'date'),
+    )
+
+    date = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('Products.id', ondelete='CASCADE'), primary_key=True)
+    store_owner_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('Category.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+class DailyOrderStats(db.Model):
+    __tablename__ = 'DailyOrderStats'
+
+    # Number of orders placed on the date that are in the status now
+    date = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(16), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from jinja2 import Template
+from .instances import app
+
+# PDFs are rendered by a pool of renderer processes. Every process parses the template and its stylesheet and loads the
+# fonts once, when it starts, and then renders every report it is sent to a PDF in memory (returned as bytes).
+# Rendering is CPU bound, so it runs in parallel beside the celery worker (which may be a single gevent process).
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+STYLE = re.compile(r'<style>(.*?)</style>', re.S)
+
+# Rendered once by every process when it starts, so the fonts are loaded before the first report
+WARM_UP_DATA = {
+    'username': 'MyBasket', 'email': '', 'month': 'January', 'totalExpenditure': 1.0,
+    'orders': [{'id': 1, 'status': 'Delivered', 'created_at': '01 January 2024', 'total': 1.0, 'items': [{'title': 'Item', 'quantity': 1, 'price': 1.0}]}],
+}
+
+
+class Renderer:
+    """
+    Renders the HTML template to PDFs. The stylesheet (the <style> of the template, shared with the HTML mails)
+    is parsed once and the fonts it uses are loaded once, by the first render.
+    """
+
+    def __init__(self, template_name):
+        from weasyprint import CSS, HTML
+        from weasyprint.text.fonts import FontConfiguration
+        with open(os.path.join(TEMPLATES, template_name)) as file:
+            source = file.read()
+        self.HTML = HTML
+        self.font_config = FontConfiguration()
+        self.stylesheets = [CSS(string='\n'.join(STYLE.findall(source)), font_config=self.font_config)]
+        self.template = Template(STYLE.sub('', source))
+
+    def render(self, data):
+        html = self.HTML(string=self.template.render(data=data))
+        return html.write_pdf(stylesheets=self.stylesheets, font_config=self.font_config)
+
+
+# ------------------------ Renderer processes ------------------------
+
+_renderers = {}
+
+def _start_renderer(template_names):
+    for template_name in template_names:
+        _renderers[template_name] = Renderer(template_name)
+        _renderers[template_name].render(WARM_UP_DATA)
+
+def _render(template_name, data):
+    return _renderers[template_name].render(data)
+
+
+# ------------------------ Pool ------------------------
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+def renderer_pool(restart=False):
+    # Started on first use in every (forked) worker process. The renderers are spawned, not forked,
+    # so they do not inherit the threads, connections and gevent patches of the worker. Spawned processes import the
+    # __main__ module of the parent, which must not start anything outside of `if __name__ == '__main__'` (celery's does not).
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid() or restart:
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = ProcessPoolExecutor(
+                max_workers=app.config['PDF_RENDER_PROCESSES'] or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_start_renderer,
+                initargs=(app.config['PDF_TEMPLATES'],),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+def submit_pdf(data, template_name='monthlyReport.html'):
+    # Returns a future of the PDF (bytes)
+    try:
+        return renderer_pool().submit(_render, template_name, data)
+    except BrokenProcessPool:
+        # A renderer died (e.g. killed for its memory), the pool can not be used anymore
+        return renderer_pool(restart=True).submit(_render, template_name, data)
+
+def render_pdf(data, template_name='monthlyReport.html'):
+    return submit_pdf(data, template_name).result()
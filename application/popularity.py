@@ -0,0 +1,85 @@
+import math
+import sqlite3
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert
+from .instances import db, app
+from .models import Products, ProductPopularity, Orders, ItemsOrdered
+
+# Scores are log(sum(quantity * e^((sold_at - EPOCH) / period))), see ProductPopularity
+EPOCH = datetime(2023, 1, 1)
+
+def _logaddexp(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+# SQLite has no exp/log functions, so the score update is registered as a function on every connection.
+# This keeps the update a single atomic upsert statement.
+@event.listens_for(Engine, 'connect')
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('logaddexp', 2, _logaddexp, deterministic=True)
+
+def sale_score(quantity, sold_at, period):
+    return math.log(quantity) + (sold_at - EPOCH).total_seconds() / period.total_seconds()
+
+def record_sales(sales, sold_at=None):
+    # Adds the (product_id, quantity) sales to the popularity of the products in every period.
+    # It runs in the caller's transaction, so it is committed together with the order.
+    sold_at = sold_at or datetime.utcnow()
+    quantities = {}
+    for product_id, quantity in sales:
+        if quantity > 0:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+    if not quantities:
+        return
+    rows = [
+        {'product_id': product_id, 'period': name, 'score': sale_score(quantity, sold_at, period), 'updated_at': sold_at}
+        for name, period in app.config['POPULARITY_PERIODS'].items()
+        for product_id, quantity in quantities.items()
+    ]
+    statement = insert(ProductPopularity).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ProductPopularity.product_id, ProductPopularity.period],
+        set_={
+            'score': db.func.logaddexp(ProductPopularity.score, statement.excluded.score),
+            'updated_at': statement.excluded.updated_at,
+        },
+    )
+    db.session.execute(statement)
+
+def trending_products(period):
+    # Products ordered by their decayed sales in the period, products never sold are left out
+    return (
+        Products.query
+        .join(ProductPopularity, ProductPopularity.product_id == Products.id)
+        .filter(ProductPopularity.period == period)
+        .order_by(ProductPopularity.score.desc())
+    )
+
+def rebuild_popularity():
+    # Recomputes the read model from the order history (for existing databases or a changed period config)
+    periods = app.config['POPULARITY_PERIODS']
+    scores = {}
+    sales = (
+        db.session.query(ItemsOrdered.item_id, ItemsOrdered.quantity, Orders.created_at)
+        .join(Orders, Orders.id == ItemsOrdered.order_id)
+        .filter(ItemsOrdered.quantity > 0)
+        .execution_options(yield_per=1000)
+    )
+    for product_id, quantity, created_at in sales:
+        for name, period in periods.items():
+            key = (product_id, name)
+            scores[key] = _logaddexp(scores.get(key), sale_score(quantity, created_at, period))
+    ProductPopularity.query.delete()
+    now = datetime.utcnow()
+    db.session.add_all(
+        ProductPopularity(product_id=product_id, period=name, score=score, updated_at=now)
+        for (product_id, name), score in scores.items()
+    )
+    db.session.commit()
@@ -0,0 +1,42 @@
+import logging
+from functools import wraps
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .instances import app
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# Counts the SQL statements executed while handling the current request
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+def query_count():
+    return g.get('query_count', 0)
+
+def query_budget(max_queries):
+    """
+    Declares the most SQL statements the endpoint may run, whatever the number of rows (N+1 detector).
+    It has to be the first decorator below the route, so the queries of the other decorators are counted too.
+    Going over the budget raises QueryBudgetExceeded when testing (or with QUERY_BUDGET_STRICT), otherwise it is logged.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = query_count()
+            response = fn(*args, **kwargs)
+            used = query_count() - start
+            if used > max_queries:
+                message = f'{fn.__name__} ran {used} queries, its budget is {max_queries}'
+                if app.testing or app.config.get('QUERY_BUDGET_STRICT'):
+                    raise QueryBudgetExceeded(message)
+                logging.warning(message)
+            return response
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
@@ -1,13 +1,17 @@
 from functools import wraps
-from flask_jwt_extended import get_jwt_identity
-from application.models import User
+from flask_jwt_extended import get_jwt
 
 
+# Authorisation is done from the claims signed into the access token (see application.tokens),
+# so the decorators do not query the user. Role id 1 is customer, 2 is store manager and 3 is admin.
+def has_role(*role_ids):
+    claims = get_jwt()
+    return claims.get('active', False) and claims.get('role_id') in role_ids
+
 def admin_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        current_user = User.query.filter_by(username=get_jwt_identity()).first()
-        if current_user and current_user.role_id == 3:
+        if has_role(3):
             return fn(*args, **kwargs)
         else:
             return {"message": "Permission denied"}, 403
@@ -16,8 +20,7 @@ def admin_required(fn):
 def store_manager_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        current_user = User.query.filter_by(username=get_jwt_identity()).first()
-        if current_user and current_user.role_id == 2:
+        if has_role(2):
             return fn(*args, **kwargs)
         else:
             return {"message": "Permission denied"}, 403
@@ -26,8 +29,7 @@ def store_manager_required(fn):
 def owner_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        current_user = User.query.filter_by(username=get_jwt_identity()).first()
-        if current_user and current_user.role_id == 2 or current_user.role_id == 3:
+        if has_role(2, 3):
             return fn(*args, **kwargs)
         else:
             return {"message": "Permission denied"}, 403
@@ -36,8 +38,7 @@ def owner_required(fn):
 def customer_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        current_user = User.query.filter_by(username=get_jwt_identity()).first()
-        if current_user and current_user.role_id == 1:
+        if has_role(1):
             return fn(*args, **kwargs)
         else:
             return {"message": "Permission denied"}, 403
@@ -0,0 +1,72 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from .instances import db, app
+from .models import Products, Orders, ItemsOrdered, DailyProductSales, DailyOrderStats
+
+# The functions below run in the caller's transaction, so the rollups are committed together with the order.
+
+def record_order(order, sales):
+    # Adds the order and its (product, quantity, price per quantity) sales to the rollups of the day it was placed
+    date = order.created_at.date()
+    rows = {}
+    for product, quantity, price in sales:
+        row = rows.setdefault(product.id, {
+            'date': date, 'product_id': product.id, 'store_owner_id': product.store_owner_id,
+            'category_id': product.category_id, 'quantity': 0, 'revenue': 0,
+        })
+        row['quantity'] += quantity
+        row['revenue'] += quantity * price
+    if rows:
+        statement = insert(DailyProductSales).values(list(rows.values()))
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[DailyProductSales.date, DailyProductSales.product_id],
+            set_={
+                'quantity': DailyProductSales.quantity + statement.excluded.quantity,
+                'revenue': DailyProductSales.revenue + statement.excluded.revenue,
+            },
+        ))
+    _add_orders(date, order.status, 1)
+
+def record_status_change(order, previous_status):
+    if previous_status == order.status:
+        return
+    date = order.created_at.date()
+    _add_orders(date, previous_status, -1)
+    _add_orders(date, order.status, 1)
+
+def _add_orders(date, status, count):
+    statement = insert(DailyOrderStats).values(date=date, status=status, orders=count)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[DailyOrderStats.date, DailyOrderStats.status],
+        set_={'orders': DailyOrderStats.orders + statement.excluded.orders},
+    ))
+
+def forget_product_sales(product_id):
+    # The sales of a deleted product go with its ordered items
+    DailyProductSales.query.filter_by(product_id=product_id).delete()
+
+
+def rebuild_rollups():
+    # Recomputes the rollups from the order history (for existing databases)
+    DailyProductSales.query.delete()
+    DailyOrderStats.query.delete()
+    day = func.date(Orders.created_at)
+    db.session.execute(insert(DailyProductSales).from_select(
+        ['date', 'product_id', 'store_owner_id', 'category_id', 'quantity', 'revenue'],
+        db.select(day, ItemsOrdered.item_id, Products.store_owner_id, Products.category_id,
+                  func.sum(ItemsOrdered.quantity), func.sum(ItemsOrdered.quantity * ItemsOrdered.price_per_quantity))
+        .join(Orders, Orders.id == ItemsOrdered.order_id)
+        .join(Products, Products.id == ItemsOrdered.item_id)
+        .group_by(day, ItemsOrdered.item_id),
+    ))
+    db.session.execute(insert(DailyOrderStats).from_select(
+        ['date', 'status', 'orders'],
+        db.select(day, Orders.status, func.count()).group_by(day, Orders.status),
+    ))
+    db.session.commit()
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuilds the daily sales and order rollups from the orders."""
+    rebuild_rollups()
+    print(f'{DailyProductSales.query.count()} daily product sales, {DailyOrderStats.query.count()} daily order stats')
@@ -0,0 +1,57 @@
+import re
+from sqlalchemy import func, literal_column, select, table, column, text
+from .instances import db
+
+# Full text index over the title and description of the products (SQLite FTS5).
+# It is an external content table, the rows are read from Products and kept in sync by the triggers below.
+products_search = table('ProductsSearch', column('rowid'), column('title'), column('description'))
+
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS ProductsSearch USING fts5(
+        title, description, content='Products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS ProductsSearch_insert AFTER INSERT ON Products BEGIN
+        INSERT INTO ProductsSearch(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ProductsSearch_delete AFTER DELETE ON Products BEGIN
+        INSERT INTO ProductsSearch(ProductsSearch, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ProductsSearch_update AFTER UPDATE OF title, description ON Products BEGIN
+        INSERT INTO ProductsSearch(ProductsSearch, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO ProductsSearch(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+def search_index_supported():
+    return db.engine.dialect.name == 'sqlite'
+
+def create_search_index():
+    # Creates the index (if missing) and fills it from the existing products
+    if not search_index_supported():
+        return
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'ProductsSearch'")).first()
+    for statement in SEARCH_INDEX_DDL:
+        db.session.execute(text(statement))
+    if not exists:
+        db.session.execute(text("INSERT INTO ProductsSearch(ProductsSearch) VALUES ('rebuild')"))
+    db.session.commit()
+
+def build_match_query(search_term):
+    # Every word of the search term has to match as a prefix of a word (search as you type)
+    # Words are quoted so that FTS5 operators in user input are matched literally
+    words = re.findall(r'\w+', search_term)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def search_matches(search_term):
+    # Subquery of (product_id, rank) of the products matching the search term. Lower rank is a better match.
+    # Matches in the title weigh ten times more than matches in the description
+    match_query = build_match_query(search_term)
+    if match_query is None:
+        return None
+    return select(
+        products_search.c.rowid.label('product_id'),
+        func.bm25(literal_column('ProductsSearch'), 10.0, 1.0).label('rank'),
+    ).where(literal_column('ProductsSearch').op('MATCH')(match_query)).subquery()
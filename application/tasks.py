@@ -2,8 +2,7 @@ import logging
 from celery import shared_task
 from application.models import User, Orders
 from jinja2 import Template
-from weasyprint import HTML
-import uuid
+from functools import lru_cache
 import os
 from datetime import datetime, timedelta
 
@@ -11,135 +10,217 @@ logging.basicConfig(filename='logs/tasks.log', level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 def getUserToRemind(notPurchasedToday = False):
+    """
+    Yields the customers (id, username and email) who have not visited the app in the last 24 hours, or who have not
+    placed an order in them, REMINDER_CHUNK_SIZE at a time in id order. They are never all loaded at once.
+    """
+    from application.instances import db, app
     last_24_hours = datetime.now() - timedelta(hours=24)
-    try:
-        # Role Id = 1 for customers
-        if not notPurchasedToday:
-            users = User.query.filter(User.role_id == 1, User.last_activity <= last_24_hours).all()
-            logging.info(f'Users to send daily reminder for not visiting the app today: {users}')
-            return users
-        else:
-            orders = Orders.query.filter(Orders.created_at >= last_24_hours).all()
-            user_ids = [order.customer_id for order in orders]
-            users = User.query.filter(User.role_id == 1, ~User.id.in_(user_ids)).all()
-            logging.info(f'Users to send daily reminder for not purchasing today: {users}')
-            return users
-    except Exception as e:
-        logging.info(f'Error in getting users: {e}')
-        return None
+    if not notPurchasedToday:
+        condition = User.last_activity <= last_24_hours
+    else:
+        # Anti-join, answered by the index on the orders of a customer by date
+        condition = ~db.select(Orders.id).where(Orders.customer_id == User.id, Orders.created_at >= last_24_hours).exists()
+    chunk_size = app.config['REMINDER_CHUNK_SIZE']
+    # Role Id = 1 for customers
+    statement = db.select(User.id, User.username, User.email).where(User.role_id == 1, condition).order_by(User.id).limit(chunk_size)
+    last_id, count = 0, 0
+    while True:
+        users = db.session.execute(statement.where(User.id > last_id)).all()
+        yield from users
+        count += len(users)
+        if len(users) < chunk_size:
+            break
+        last_id = users[-1].id
+    logging.info(f'Users to send daily reminder for not {"purchasing" if notPurchasedToday else "visiting the app"} today: {count}')
 
 @shared_task()
 def remainder_emails():
-    from application.utils.mail import sendMail
+    from application.utils.mail import MailQueue
     try:
-        not_visited_users = getUserToRemind()
-        for user in not_visited_users:
-            data = {'username': user.username, 'email': user.email}
-            message = formatMessage(data, template='visitReminder')
-            response = sendMail(data['email'],"Daily Reminder for visiting MyBasket Store",message, ATTACHMENT=None, mime_type="text/html")
-            logging.info('Successfully sent visit remainder emails')
-        not_purchased_users = getUserToRemind(notPurchasedToday=True)
-        for user in not_purchased_users:
-            data = {'username': user.username, 'email': user.email}
-            message = formatMessage(data, template='purchaseReminder')
-            response = sendMail(data['email'],"Daily Reminder for purchasing at MyBasket Store",message, ATTACHMENT=None, mime_type="text/html")
-            logging.info('Successfully sent purchase remainder emails')
+        with MailQueue() as outbox:
+            for user in getUserToRemind():
+                data = {'username': user.username, 'email': user.email}
+                message = formatMessage(data, template='visitReminder')
+                outbox.add(data['email'],"Daily Reminder for visiting MyBasket Store",message, ATTACHMENT=None, mime_type="text/html")
+            logging.info('Successfully queued visit remainder emails')
+            for user in getUserToRemind(notPurchasedToday=True):
+                data = {'username': user.username, 'email': user.email}
+                message = formatMessage(data, template='purchaseReminder')
+                outbox.add(data['email'],"Daily Reminder for purchasing at MyBasket Store",message, ATTACHMENT=None, mime_type="text/html")
+            logging.info('Successfully queued purchase remainder emails')
         return 'Successfully Sent'
     except Exception as e:
         logging.info(f'Error in getting users: {e}')
         return 'Failed to send'
 
+@shared_task(ignore_result=False)
+def sendMailBatch(messages):
+    # Sends the batch over one SMTP connection. Messages failing for a reason that may go away are retried
+    # on their own, with backoff, up to MAIL_MAX_RETRIES times.
+    from application.utils.mail import deliver, retryDelay
+    from application.instances import app
+    sent, retry, failed = deliver(messages)
+    retrying = 0
+    for message in retry:
+        if message['attempt'] >= app.config['MAIL_MAX_RETRIES']:
+            failed += 1
+            continue
+        sendMailBatch.apply_async(args=[[dict(message, attempt=message['attempt'] + 1)]], countdown=retryDelay(message['attempt']))
+        retrying += 1
+    logging.info(f'Mails sent: {sent}, retrying: {retrying}, failed: {failed}')
+    return {'sent': sent, 'retrying': retrying, 'failed': failed}
+
 @shared_task(ignore_result=False)
 def reminder_google_chat():
     from application.utils.webhook_reminder import google_chat_reminder
-    not_visited_users = getUserToRemind()
-    response = google_chat_reminder(not_visited_users)
-    if(response): return 'Successfully Sent'
-    else : return 'Failed to send'
+    try:
+        stats = google_chat_reminder(getUserToRemind())
+    except Exception as e:
+        logging.info(f'Error in getting users: {e}')
+        return 'Failed to send'
+    logging.info(f'Google Chat reminders: {stats}')
+    return stats
 
 
-def formatMessage(data, template='visitReminder'):
+@shared_task(ignore_result=False)
+def create_image_variants(filename, product_id=None):
+    from application.utils.images import create_variants
+    from application.cachetags import bump_tags, row_tags
+    from application.instances import db
+    from application.models import Products
+    try:
+        created = create_variants(filename)
+        logging.info(f'Created image variants {created} for {filename}')
+        # The cached listings of the product still point to the original image
+        product = db.session.get(Products, product_id) if product_id is not None else None
+        if created and product is not None:
+            bump_tags(row_tags(product))
+        return created
+    except Exception as e:
+        logging.info(f'Error in creating image variants for {filename}: {e}')
+        return None
+
+
+# Templates are read and parsed once per process
+@lru_cache(maxsize=None)
+def loadTemplate(template):
     template_path = os.path.join(os.path.dirname(__file__), 'templates', f'{template}.html')
     with open(template_path, 'r') as message_template:
-        template_content = message_template.read()
-        template = Template(template_content)
-        message = template.render(data=data)
-    return message
+        return Template(message_template.read())
+
+def formatMessage(data, template='visitReminder'):
+    return loadTemplate(template).render(data=data)
 
 
-@shared_task(shared_task(ignore_result=False))
+@shared_task(ignore_result=False)
 def monthlyReport():
-    from application.models import User, Orders, ItemsOrdered
-    users = User.query.filter_by(role_id = 1).all()
+    # Fans out the reports of the customers who ordered in the last 30 days, MONTHLY_REPORT_CHUNK_SIZE customers per
+    # sendMonthlyReports task, so the workers render and send them in parallel. summarizeMonthlyReports runs once all are done.
+    from celery import chord
+    from application.instances import db, app
     today = datetime.now()
     starting_date = today - timedelta(days=30)
-    try:
-        # Loop over all the users and send them the report
-        for user in users:
-            orders = Orders.query.filter(Orders.customer_id == user.id, Orders.created_at >= starting_date).all()
-            data = {}
-            data['orders']=[]
-            data['username'] = user.username
-            data['email'] = user.email
-            data['month'] = today.strftime("%B")
-            totalExpenditure = 0
-
-            if len(orders) == 0:
+    customers = db.select(Orders.customer_id).join(User, User.id == Orders.customer_id).where(
+        User.role_id == 1, Orders.created_at >= starting_date
+    ).group_by(Orders.customer_id).order_by(Orders.customer_id)
+    result = db.session.execute(customers.execution_options(yield_per=app.config['MONTHLY_REPORT_CHUNK_SIZE']))
+    chunks = [
+        sendMonthlyReports.s([customer_id for customer_id, in chunk], starting_date.isoformat(), today.strftime("%B"))
+        for chunk in result.partitions()
+    ]
+    # Customers without orders in the month get no report
+    skipped = User.query.filter_by(role_id=1).count() - sum(len(chunk.args[0]) for chunk in chunks)
+    if not chunks:
+        return summarizeMonthlyReports([], skipped)
+    chord(chunks)(summarizeMonthlyReports.s(skipped))
+    logging.info(f'Monthly reports of {sum(len(chunk.args[0]) for chunk in chunks)} customers split into {len(chunks)} tasks')
+    return True
+
+@shared_task(ignore_result=False)
+def sendMonthlyReports(customer_ids, starting_date, month):
+    # The orders and items of all the customers of the chunk are read by one query ordered by customer,
+    # and every customer's report is sent as soon as their rows have been read
+    from collections import deque
+    from itertools import groupby
+    from application.instances import db, app
+    from application.models import ItemsOrdered, Products
+    from application.pdfs import submit_pdf
+    from application.utils.mail import MailQueue
+    rows = db.session.execute(db.select(
+        Orders.customer_id, User.username, User.email, User.report_type, Orders.id.label('order_id'), Orders.status,
+        Orders.created_at, Products.title, ItemsOrdered.quantity, ItemsOrdered.price_per_quantity,
+    ).join(User, User.id == Orders.customer_id).join(ItemsOrdered, ItemsOrdered.order_id == Orders.id).join(
+        Products, Products.id == ItemsOrdered.item_id
+    ).where(
+        Orders.customer_id.in_(customer_ids), Orders.created_at >= datetime.fromisoformat(starting_date)
+    ).order_by(Orders.customer_id, Orders.id, ItemsOrdered.id).execution_options(yield_per=app.config['MONTHLY_REPORT_CHUNK_SIZE']))
+    # Sent counts the reports handed to the mail queue, sendMailBatch reports their delivery
+    summary = {'sent': 0, 'skipped': 0, 'failed': 0}
+
+    def send(customer_id, send_report):
+        try:
+            sent = send_report()
+        except Exception as e:
+            logging.info(f'Error in sending the monthly report of customer {customer_id}: {e}')
+            sent = False
+        summary['sent' if sent else 'failed'] += 1
+    # PDF reports are rendered by the renderer processes while the next customers are read, up to PDF_RENDER_MAX_PENDING at a time
+    pending = deque()
+    reported = set()
+    with MailQueue() as outbox:
+        for customer_id, customer_rows in groupby(rows, key=lambda row: row.customer_id):
+            reported.add(customer_id)
+            customer_rows = list(customer_rows)
+            data = monthlyReportData(customer_rows, month)
+            if customer_rows[0].report_type == 'HTML':
+                send(customer_id, lambda: sendHtmlReport(outbox, data))
                 continue
-            for order in orders:
-                order_dict = {}
-                items = order.items_ordered
-                order_dict['id'] = order.id
-                order_dict['status'] = order.status
-                order_dict['created_at'] = order.created_at.strftime("%d %B %Y")
-                order_dict['items'] = []
-                orderTotal = 0
-                for item in items:
-                    item_dict = {}
-                    item_dict['title'] = item.item.title
-                    item_dict['quantity'] = item.quantity
-                    item_dict['price'] = item.price_per_quantity.__round__(2)
-                    order_dict['items'].append(item_dict)
-                    orderTotal += item.price_per_quantity*item.quantity
-                order_dict['total'] = orderTotal.__round__(2)
-                if order.status != 'Cancelled' and order.status != 'Returned':
-                    totalExpenditure += orderTotal
-                data['orders'].append(order_dict)
-            data['totalExpenditure'] = totalExpenditure.__round__(2)
-            print(data)
-            if data['orders'] == [{}] or data['orders'] == []:
-                data['orders'] = None
-            from application.utils.mail import sendMail
-            if user.report_type == 'HTML':
-                message = formatMessage(data,'monthlyReport')
-                sendMail(user.email, 'Monthly HTML Report', message, mime_type='text/html')
-            else:
-                file = create_pdf(data)
-                if(file):
-                    sendMail(user.email, 'Monthly PDF Report', 'Please find the attached Monthly Report', ATTACHMENT=file, mime_type='application/pdf')
-                else:
-                    os.remove(os.path.join(os.path.dirname(__file__), 'static/PDF', file))
-        return True
-    except Exception as e:
-        print(e)
-        return False
+            pending.append((customer_id, data, submit_pdf(data)))
+            if len(pending) >= app.config['PDF_RENDER_MAX_PENDING']:
+                customer_id, data, pdf = pending.popleft()
+                send(customer_id, lambda: sendPdfReport(outbox, data, pdf.result()))
+        while pending:
+            customer_id, data, pdf = pending.popleft()
+            send(customer_id, lambda: sendPdfReport(outbox, data, pdf.result()))
+    # Customers of the chunk without a report, their orders were deleted since the chunk was made
+    summary['skipped'] = len(set(customer_ids) - reported)
+    return summary
 
+@shared_task(ignore_result=False)
+def summarizeMonthlyReports(results, skipped=0):
+    summary = {
+        'sent': sum(result['sent'] for result in results),
+        'skipped': skipped + sum(result['skipped'] for result in results),
+        'failed': sum(result['failed'] for result in results),
+    }
+    logging.info(f'Monthly reports sent: {summary["sent"]}, skipped: {summary["skipped"]}, failed: {summary["failed"]}')
+    return summary
 
-# It takes a template file and data and returns the formatted message
-def format_report(template_file, data=[]):
-    template_path =os.path.join(os.path.dirname(__file__), 'templates', template_file)
-    try:
-        with open(template_path, 'r') as file_:
-            template = Template(file_.read())
-            return template.render(data=data)
-    except FileNotFoundError:
-        print(f"Error: File '{template_path}' not found.")
-        return None
+# Report data of a customer from their rows (one per item ordered, ordered by order)
+def monthlyReportData(rows, month):
+    from itertools import groupby
+    data = {'username': rows[0].username, 'email': rows[0].email, 'month': month, 'orders': []}
+    totalExpenditure = 0
+    for order_id, items in groupby(rows, key=lambda row: row.order_id):
+        items = list(items)
+        orderTotal = sum(item.price_per_quantity*item.quantity for item in items)
+        data['orders'].append({
+            'id': order_id,
+            'status': items[0].status,
+            'created_at': items[0].created_at.strftime("%d %B %Y"),
+            'items': [{'title': item.title, 'quantity': item.quantity, 'price': item.price_per_quantity.__round__(2)} for item in items],
+            'total': orderTotal.__round__(2),
+        })
+        if items[0].status != 'Cancelled' and items[0].status != 'Returned':
+            totalExpenditure += orderTotal
+    data['totalExpenditure'] = totalExpenditure.__round__(2)
+    return data
+
+def sendHtmlReport(outbox, data):
+    message = formatMessage(data,'monthlyReport')
+    return outbox.add(data['email'], 'Monthly HTML Report', message, mime_type='text/html')
 
-# It creates a PDF file and returns the filename
-def create_pdf(data):
-    message = format_report('monthlyReport.html',data)
-    html = HTML(string=message)
-    file_name = os.path.join(os.path.dirname(__file__), 'static/PDF', str(uuid.uuid4())+'.pdf')
-    html.write_pdf(target=file_name)
-    return file_name
+def sendPdfReport(outbox, data, pdf):
+    # The PDF is attached from memory, it is never written to a file
+    return outbox.add(data['email'], 'Monthly PDF Report', 'Please find the attached Monthly Report', ATTACHMENT=pdf, mime_type='application/pdf')
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from flask_caching.backends import RedisCache
+from .metrics import count_cache_lookup
+from .utils.lru import SizedLRU
+
+# Keys changed through the cache are published here, so every worker evicts them from its local tier
+INVALIDATION_CHANNEL = 'cache_invalidations'
+ALL_KEYS = '*'
+
+
+class TieredRedisCache(RedisCache):
+    """
+    RedisCache with a local tier: values read from redis are kept unpickled in a size bounded LRU of the process.
+    Every write through the cache evicts the key locally and publishes it on INVALIDATION_CHANNEL, a listener thread
+    in every worker evicts the published keys. While the listener is not subscribed, the local tier is not used.
+    Values from the local tier are shared by the requests of the process, they must be treated as read only.
+    """
+
+    def __init__(self, *args, local_max_bytes=64 * 1024 * 1024, local_timeout=300, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = SizedLRU(local_max_bytes, local_timeout)
+        self.synced = False
+        self.pid = None
+        # Identifies the messages of this process, it has evicted its own keys already
+        self.sender = None
+        self.lock = threading.Lock()
+        # Incremented on every invalidation, a value read from redis while it changed is not kept locally
+        self.epoch = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            local_max_bytes=config.get('CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024),
+            local_timeout=config.get('CACHE_LOCAL_TIMEOUT', 300),
+        )
+        return super().factory(app, config, args, kwargs)
+
+    # ------------------------ Invalidation ------------------------
+
+    def ensure_started(self):
+        # Started lazily, once in every (forked) worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.sender = uuid.uuid4().hex
+                self.synced = False
+                self.local.clear()
+                threading.Thread(target=self._listen, name='cache-invalidation', daemon=True).start()
+
+    def _listen(self):
+        channel = self._get_prefix() + INVALIDATION_CHANNEL
+        while True:
+            try:
+                pubsub = self._write_client.pubsub()
+                pubsub.subscribe(channel)
+                while pubsub.get_message(timeout=5) is None:
+                    pass
+                # Whatever was kept while not subscribed may have changed since
+                self.local.clear()
+                self.synced = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    message = json.loads(message['data'])
+                    if message['sender'] == self.sender:
+                        continue
+                    self.epoch += 1
+                    keys = message['keys']
+                    if keys == ALL_KEYS:
+                        self.local.clear()
+                    else:
+                        for key in keys:
+                            self.local.delete(key)
+            except Exception as e:
+                logging.warning(f'Local cache lost its redis subscription: {e}')
+            self.synced = False
+            self.epoch += 1
+            time.sleep(1)
+
+    def _evict(self, keys):
+        self.epoch += 1
+        if keys == (ALL_KEYS,):
+            self.local.clear()
+        else:
+            for key in keys:
+                self.local.delete(key)
+
+    def _invalidation_message(self, keys):
+        return json.dumps({'sender': self.sender, 'keys': ALL_KEYS if keys == (ALL_KEYS,) else list(keys)})
+
+    def _invalidate(self, *keys):
+        # Called once redis holds the new values
+        self._evict(keys)
+        self.ensure_started()
+        self._write_client.publish(self._get_prefix() + INVALIDATION_CHANNEL, self._invalidation_message(keys))
+
+    # ------------------------ Reads ------------------------
+
+    def _local_get(self, key):
+        if not self.synced:
+            return False, None
+        found, value = self.local.get(key)
+        count_cache_lookup('local', found)
+        return found, value
+
+    def get(self, key):
+        self.ensure_started()
+        found, value = self._local_get(key)
+        if found:
+            return value
+        epoch = self.epoch
+        # The value is not kept locally for longer than it has left in redis
+        pipeline = self._read_client.pipeline(transaction=False)
+        pipeline.get(self._get_prefix() + key)
+        pipeline.pttl(self._get_prefix() + key)
+        dump, ttl = pipeline.execute()
+        value = self.serializer.loads(dump)
+        count_cache_lookup('redis', value is not None)
+        if value is not None and self.synced and epoch == self.epoch:
+            self.local.set(key, value, len(dump), ttl / 1000 if ttl > 0 else None)
+        return value
+
+    def get_many(self, *keys):
+        # Used for the tag versions (kept without expiry), which are not counted as cache lookups
+        self.ensure_started()
+        values = {}
+        missing = []
+        for key in keys:
+            found, value = self.local.get(key) if self.synced else (False, None)
+            if found:
+                values[key] = value
+            else:
+                missing.append(key)
+        if missing:
+            epoch = self.epoch
+            dumps = self._read_client.mget([self._get_prefix() + key for key in missing])
+            for key, dump in zip(missing, dumps):
+                values[key] = self.serializer.loads(dump)
+                # Missing keys are kept too (a tag never bumped), setting them publishes their eviction like any write
+                if self.synced and epoch == self.epoch:
+                    self.local.set(key, values[key], len(dump or b''))
+        return [values[key] for key in keys]
+
+    # ------------------------ Writes ------------------------
+
+    def set(self, key, value, timeout=None):
+        result = super().set(key, value, timeout)
+        self._invalidate(key)
+        return result
+
+    def add(self, key, value, timeout=None):
+        created = super().add(key, value, timeout)
+        if created:
+            self._invalidate(key)
+        return created
+
+    def set_many(self, mapping, timeout=None):
+        result = super().set_many(mapping, timeout)
+        self._invalidate(*mapping.keys())
+        return result
+
+    def delete(self, key):
+        result = super().delete(key)
+        self._invalidate(key)
+        return result
+
+    def delete_many(self, *keys):
+        result = super().delete_many(*keys)
+        self._invalidate(*keys)
+        return result
+
+    def clear(self):
+        result = super().clear()
+        self._invalidate(ALL_KEYS)
+        return result
+
+    def inc(self, key, delta=1):
+        result = super().inc(key, delta)
+        self._invalidate(key)
+        return result
+
+    def dec(self, key, delta=1):
+        result = super().dec(key, delta)
+        self._invalidate(key)
+        return result
+
+    def shared_lock(self, key, timeout):
+        # Redis lock shared by all the workers
+        return self._write_client.lock(self._get_prefix() + key, timeout=timeout)
+
+    def inc_many(self, *keys):
+        # Increments the keys and publishes their invalidation in one round trip
+        pipeline = self._write_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(self._get_prefix() + key)
+        self.ensure_started()
+        pipeline.publish(self._get_prefix() + INVALIDATION_CHANNEL, self._invalidation_message(keys))
+        result = pipeline.execute()[:len(keys)]
+        # Evicted only once redis holds the new values. A read evicted before would keep the old value locally,
+        # and the invalidation message of this process is ignored by its own listener.
+        self._evict(keys)
+        return result
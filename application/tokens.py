@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+import redis
+from flask_jwt_extended import create_access_token
+from .instances import app, db
+from .utils.bloomfilter import BloomFilter
+
+# Setup redis connection for storing the blocklisted tokens and the token versions of the users.
+jwt_redis_blocklist = redis.StrictRedis(
+    host="localhost", port=6379, db=0, decode_responses=True
+)
+
+# Every revoked key (a token jti or a token_version key) is also added to this sorted set (scored by expiry time),
+# so the local filters can be rebuilt, and published on this channel, so the local filters stay in sync.
+REVOKED_KEYS = 'revoked_tokens'
+REVOKED_CHANNEL = 'revoked_tokens'
+
+def token_version_key(user_id):
+    return f'token_version:{user_id}'
+
+
+class RevokedTokenFilter:
+    """
+    In process bloom filter of the revoked keys kept in redis. A miss means the token was never revoked,
+    only a hit has to be confirmed from redis. The filter is filled from REVOKED_KEYS and then kept up to date
+    by a listener thread subscribed to REVOKED_CHANNEL. While the listener is not subscribed, the filter is not
+    trusted and every token is checked in redis.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.filter = None
+        self.synced = False
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        # Started lazily, once in every (forked) worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.synced = False
+                threading.Thread(target=self._listen, name='revoked-token-filter', daemon=True).start()
+
+    def rebuild(self):
+        now = time.time()
+        self.connection.zremrangebyscore(REVOKED_KEYS, '-inf', now)
+        keys = self.connection.zrangebyscore(REVOKED_KEYS, now, '+inf')
+        revoked = BloomFilter(max(app.config['REVOKED_TOKEN_FILTER_CAPACITY'], 2 * len(keys)), app.config['REVOKED_TOKEN_FILTER_ERROR_RATE'])
+        for key in keys:
+            revoked.add(key)
+        self.filter = revoked
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.connection.pubsub()
+                pubsub.subscribe(REVOKED_CHANNEL)
+                # Wait for the subscription before reading the revoked keys, so no revocation falls in between
+                while pubsub.get_message(timeout=5) is None:
+                    pass
+                self.rebuild()
+                self.synced = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    self.filter.add(message['data'])
+                    if self.filter.is_full():
+                        self.rebuild()
+            except Exception as e:
+                logging.warning(f'Revoked token filter lost its redis subscription: {e}')
+            self.synced = False
+            time.sleep(1)
+
+    def might_contain(self, *keys):
+        self.ensure_started()
+        if not self.synced:
+            return True
+        revoked = self.filter
+        return any(key in revoked for key in keys)
+
+
+revoked_token_filter = RevokedTokenFilter(jwt_redis_blocklist)
+
+def _add_revoked_key(key, value):
+    expires_in = app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    pipeline = jwt_redis_blocklist.pipeline()
+    pipeline.set(key, value, ex=expires_in)
+    pipeline.zadd(REVOKED_KEYS, {key: time.time() + expires_in.total_seconds()})
+    pipeline.publish(REVOKED_CHANNEL, key)
+    pipeline.execute()
+
+# Creates the access token of the user. Role, id and active state are signed into the token as claims,
+# so authorisation does not need to look the user up on every request.
+def create_user_token(user):
+    claims = {
+        'id': user.id,
+        'role_id': user.role_id,
+        'active': user.active,
+        # Tokens issued before the last revoke_user_tokens() call of the user are rejected
+        'ver': user.token_version or 0,
+    }
+    return create_access_token(identity=user.username, additional_claims=claims)
+
+# Revokes a single access token (on logout)
+def revoke_token(jti):
+    _add_revoked_key(jti, "")
+
+# Invalidates every token issued to the user so far (e.g. on role change or deactivation).
+# The new version is mirrored into redis for the lifetime of a token, older tokens have expired by then.
+def revoke_user_tokens(user):
+    user.token_version = (user.token_version or 0) + 1
+    db.session.commit()
+    _add_revoked_key(token_version_key(user.id), user.token_version)
+
+def is_token_revoked(jwt_payload):
+    # Tokens issued before the claims were added have to be renewed
+    if 'ver' not in jwt_payload:
+        return True
+    version_key = token_version_key(jwt_payload['id'])
+    # Most tokens are not revoked, they are let through without a round trip to redis
+    if not revoked_token_filter.might_contain(jwt_payload['jti'], version_key):
+        return False
+    token_in_redis, token_version = jwt_redis_blocklist.mget(jwt_payload['jti'], version_key)
+    if token_in_redis is not None:
+        return True
+    return token_version is not None and jwt_payload['ver'] < int(token_version)
@@ -1,43 +1,249 @@
-from flask_restful import reqparse, fields
-from .models import User, Products, Category, ManagerRequests
-from .instances import cache
-
-# It returns the image data in base64 format
-def getImageFromEntity(entity):
-    import os
-    from application.instances import app
-    import base64
+from flask import request
+from flask_restful import reqparse, fields, abort
+from .models import User, Products, Category, ManagerRequests, Orders, Feedback, ItemsOrdered, DailyProductSales
+from .instances import db, app
+from .utils.images import variant_exists, variant_name
+from .serializers import fast_marshal
+from .cachetags import cached_by_tags
+from .loadplans import products_load_plan, categories_load_plan, manager_requests_load_plan, orders_load_plan, feedback_load_plan, items_ordered_load_plan
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from datetime import datetime, timedelta, timezone
+from werkzeug.security import safe_join
+import base64
+import hashlib
+import json
+import os
+
+# Content digests of the uploaded images, keyed by image name.
+# The digest is recomputed only when the file's mtime or size changes.
+_image_digests = {}
+
+# It returns a short content hash of the image stored in the upload folder
+def getImageDigest(image_path):
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], image_path)
+    if full_path is None:
+        return None
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    cached = _image_digests.get(image_path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()[:16]
+    _image_digests[image_path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+# It returns the content addressed url of the image (served by /images/<digest>/<filename>)
+# If a size variant is asked for and already generated, the url of the variant is returned instead of the original
+def getImageUrl(entity, variant=None):
     # Entity can be user or product
-    image_path = entity.image
-    if image_path:
-        with open(os.path.join(app.config['UPLOAD_FOLDER'], image_path), 'rb') as f:
-            image_data = base64.b64encode(f.read())
-        return image_data
-    else:
+    image_path = entity if isinstance(entity, str) else entity.image
+    if not image_path:
+        return ''
+    if variant and variant_exists(image_path, variant):
+        image_path = variant_name(image_path, variant)
+    digest = getImageDigest(image_path)
+    if digest is None:
         return ''
+    return f'/images/{digest}/{image_path}'
 
 # These functions are used to get all the data from the database and cache it
-@cache.cached(timeout=20, key_prefix='all_products')
+@cached_by_tags('products', hot=True)
 def get_all_products():
     products = Products.query.all()
-    for product in products:
-        product.image_file = getImageFromEntity(product)
     return products
 
-@cache.cached(timeout=20, key_prefix='all_categories')
+@cached_by_tags('categories', hot=True)
 def get_all_categories():
     categories = Category.query.all()
     return categories
 
-@cache.cached(timeout=20, key_prefix='all_users')
-def get_all_users():
-    users = User.query.all()
-    return users
+@cached_by_tags('users', 'user:{store_owner_id}:products')
+def get_store_owner_products(store_owner_id):
+    products = Products.query.filter_by(store_owner_id=store_owner_id).options(*products_load_plan).all()
+    return products
+
+# Keyset pagination
+# Cursors are opaque to the clients, they carry the sort key of the last row of the previous page
+def encodeCursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+def decodeCursor(cursor):
+    # Cursors are the id of the last row of the page
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        value = None
+    if type(value) is not int:
+        abort(400, message='Invalid cursor')
+    return value
+
+# It returns the page arguments (after, limit) of the current request
+def getPageArgs():
+    after = request.args.get('after') or None
+    limit = request.args.get('limit', app.config['DEFAULT_PAGE_SIZE'], type=int)
+    return after, max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+# It parses an ISO 8601 date or date-time argument of the current request
+def parseDateArg(name, default, end_of_day=False):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, message=f'Invalid {name}, expected an ISO 8601 date')
+    # Dates are stored as naive UTC
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    # A date without a time covers the whole day
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1) - timedelta(microseconds=1)
+    return parsed
+
+# It returns the (starting_date, ending_date) of the current request, both included. By default the last 7 days.
+def getDateRangeArgs():
+    now = datetime.utcnow()
+    return parseDateArg('starting_date', now - timedelta(days=7)), parseDateArg('ending_date', now, end_of_day=True)
+
+GRANULARITIES = ('day', 'week', 'month')
+
+def getGranularityArg():
+    granularity = request.args.get('granularity') or None
+    if granularity is not None and granularity not in GRANULARITIES:
+        abort(400, message=f'Invalid granularity, expected one of {", ".join(GRANULARITIES)}')
+    return granularity
+
+# SQL expression of the first day (ISO date) of the day / week (starting on monday) / month of the datetime column
+def dateBucket(column, granularity):
+    if granularity == 'week':
+        return func.date(column, 'weekday 0', '-6 days')
+    if granularity == 'month':
+        return func.strftime('%Y-%m-01', column)
+    return func.date(column)
+
+# It returns every bucket (ISO date of its first day) between the two dates, as dateBucket names them
+def dateBuckets(starting_date, ending_date, granularity):
+    day = starting_date.date()
+    if granularity == 'week':
+        day -= timedelta(days=day.weekday())
+    elif granularity == 'month':
+        day = day.replace(day=1)
+    buckets = []
+    while day <= ending_date.date():
+        buckets.append(day.isoformat())
+        if granularity == 'week':
+            day += timedelta(days=7)
+        elif granularity == 'month':
+            day = (day + timedelta(days=32)).replace(day=1)
+        else:
+            day += timedelta(days=1)
+    return buckets
+
+# It returns one page of the query ordered by the (unique) key column and the cursor of the next page
+def paginate(query, key_column, after=None, limit=None, descending=False):
+    limit = limit or app.config['DEFAULT_PAGE_SIZE']
+    if after is not None:
+        last_key = decodeCursor(after)
+        query = query.filter(key_column < last_key if descending else key_column > last_key)
+    query = query.order_by(key_column.desc() if descending else key_column.asc())
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encodeCursor(getattr(rows[-1], key_column.key))
+    return rows, next_cursor
+
+# These functions are used to get a page of the data from the database and cache it
+# Most of them cache the serialized rows, so no lazy relationship has to be loaded from a cached (detached) object
+@cached_by_tags('products', 'users')
+def get_products_page(after=None, limit=None):
+    products, next_cursor = paginate(Products.query.options(*products_load_plan), Products.id, after, limit)
+    return fast_marshal(products, products_resource_fields), next_cursor
+
+@cached_by_tags('categories', 'users')
+def get_categories_page(after=None, limit=None):
+    categories, next_cursor = paginate(Category.query.options(*categories_load_plan), Category.id, after, limit)
+    return fast_marshal(categories, categories_resource_fields), next_cursor
+
+@cached_by_tags('users')
+def get_users_page(after=None, limit=None):
+    return paginate(User.query, User.id, after, limit)
 
-@cache.cached(timeout=20, key_prefix='all_manager_requests')
-def get_all_manager_requests():
-    requests = ManagerRequests.query.all()
-    return requests
+@cached_by_tags('manager_requests', 'users')
+def get_manager_requests_page(after=None, limit=None):
+    requests, next_cursor = paginate(ManagerRequests.query.options(*manager_requests_load_plan), ManagerRequests.id, after, limit)
+    return fast_marshal(requests, manager_request_resource_fields), next_cursor
+
+# The orders embed the title of their products
+@cached_by_tags('user:{customer_id}', 'user:{customer_id}:orders', 'products')
+def get_orders_page(customer_id, after=None, limit=None):
+    orders, next_cursor = paginate(Orders.query.filter_by(customer_id=customer_id).options(*orders_load_plan), Orders.id, after, limit)
+    return fast_marshal(orders, orders_resource_fields), next_cursor
+
+@cached_by_tags('users', 'product:{product_id}')
+def get_reviews_page(product_id, after=None, limit=None):
+    reviews, next_cursor = paginate(Feedback.query.filter_by(product_id=product_id).options(*feedback_load_plan), Feedback.id, after, limit)
+    return fast_marshal(reviews, feedback_resource_fields), next_cursor
+
+@cached_by_tags('users', 'category:{category_id}')
+def get_category_products_page(category_id, after=None, limit=None):
+    products, next_cursor = paginate(Products.query.filter_by(category_id=category_id).options(*products_load_plan), Products.id, after, limit)
+    return fast_marshal(products, products_resource_fields), next_cursor
+
+# (customer id, serialized items) of the order, the permission is checked on the customer id by the caller.
+# The items embed the title of their product.
+@cached_by_tags('users', 'order:{order_id}', 'products')
+def get_order_items(order_id):
+    order = db.session.get(Orders, order_id, options=[selectinload(Orders.items_ordered).options(*items_ordered_load_plan)])
+    if order is None:
+        return None
+    return order.customer_id, fast_marshal(order.items_ordered, items_ordered_resource_fields)
+
+# Items ordered of the products of the store owner (all the products if None) as flat rows, filtered by the order status and date
+def ordered_items_query(*columns, store_owner_id=None, status=None, starting_date=None, ending_date=None):
+    query = db.session.query(*columns).select_from(ItemsOrdered).join(Orders, Orders.id == ItemsOrdered.order_id).join(Products, Products.id == ItemsOrdered.item_id)
+    if store_owner_id is not None:
+        query = query.filter(Products.store_owner_id == store_owner_id)
+    if status is not None:
+        query = query.filter(Orders.status == status)
+    if starting_date is not None:
+        query = query.filter(Orders.created_at >= starting_date)
+    if ending_date is not None:
+        query = query.filter(Orders.created_at <= ending_date)
+    return query
+
+# One page of the items ordered, newest first. Only the columns shown are selected, no order, customer or product is loaded.
+def get_ordered_items_page(after=None, limit=None, **filters):
+    query = ordered_items_query(
+        ItemsOrdered.id, ItemsOrdered.order_id, ItemsOrdered.item_id.label('product_id'), Products.title,
+        ItemsOrdered.quantity, ItemsOrdered.price_per_quantity, Orders.status, Orders.created_at, Orders.customer_id,
+        User.username.label('customer'), **filters
+    ).join(User, User.id == Orders.customer_id)
+    items, next_cursor = paginate(query, ItemsOrdered.id, after, limit, descending=True)
+    return fast_marshal(items, ordered_item_row_fields), next_cursor
+
+# (total sales, total quantities sold) of the items ordered
+def get_ordered_items_totals(store_owner_id=None, status=None, starting_date=None, ending_date=None):
+    if status is None and starting_date is None and ending_date is None:
+        # Lifetime totals come from the daily rollups, which do not grow with the number of orders in a day.
+        # Like the items ordered, they are filtered by the current owner of the product (not its owner when sold).
+        query = db.session.query(func.sum(DailyProductSales.revenue), func.sum(DailyProductSales.quantity))
+        if store_owner_id is not None:
+            query = query.join(Products, Products.id == DailyProductSales.product_id).filter(Products.store_owner_id == store_owner_id)
+    else:
+        query = ordered_items_query(
+            func.sum(ItemsOrdered.price_per_quantity * ItemsOrdered.quantity), func.sum(ItemsOrdered.quantity),
+            store_owner_id=store_owner_id, status=status, starting_date=starting_date, ending_date=ending_date
+        )
+    totalSales, totalQuantitiesSold = query.one()
+    return totalSales or 0, totalQuantitiesSold or 0
 
 # Parsers for the API
 
@@ -137,10 +343,15 @@ products_resource_fields = {
     'unit': fields.String,
     'manufacture_date': fields.DateTime,
     'expiry_date': fields.DateTime,
-    'image_file': fields.String,
+    # Listings reference the thumbnail, product detail references the large variant
+    'image_url': fields.String(attribute=lambda product: getImageUrl(product, 'thumb')),
     'average_rating': fields.Float,
     'store_owner': fields.Nested(user_fields),
 }
+product_detail_resource_fields = {
+    **products_resource_fields,
+    'image_url': fields.String(attribute=lambda product: getImageUrl(product, 'large')),
+}
 product_fields = {
     'id': fields.Integer,
     'title': fields.String,
@@ -170,6 +381,19 @@ items_ordered_resource_fields = {
     'price_per_quantity': fields.Float,
     'order': fields.Nested(order_fields)
 }
+# Flat row of the manager orders feed
+ordered_item_row_fields = {
+    'id': fields.Integer,
+    'order_id': fields.Integer,
+    'product_id': fields.Integer,
+    'title': fields.String,
+    'quantity': fields.Integer,
+    'price_per_quantity': fields.Float,
+    'status': fields.String,
+    'created_at': fields.DateTime,
+    'customer_id': fields.Integer,
+    'customer': fields.String,
+}
 orders_resource_fields = {
     'id': fields.Integer,
     'customer_id': fields.Integer,
@@ -0,0 +1,49 @@
+from application.instances import app
+from PIL import Image, ImageOps
+from werkzeug.utils import secure_filename
+import hashlib
+import os
+
+# Derived images are stored under this folder inside the upload folder
+VARIANTS_FOLDER = 'variants'
+
+def store_upload(image):
+    # Uploads are stored by their content hash so identical images are stored only once
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image.stream.read(64 * 1024), b''):
+        digest.update(chunk)
+    image.stream.seek(0)
+    extension = os.path.splitext(secure_filename(image.filename))[1].lower()
+    filename = f'{digest.hexdigest()}{extension}'
+    img_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.exists(img_path):
+        image.save(img_path)
+    return filename
+
+def variant_name(filename, variant):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(VARIANTS_FOLDER, f'{stem}_{variant}.webp')
+
+def variant_exists(filename, variant):
+    return os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], variant_name(filename, variant)))
+
+def create_variants(filename):
+    # Creates the configured size variants (as WebP) of an uploaded image, skipping the ones already present
+    upload_folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(os.path.join(upload_folder, VARIANTS_FOLDER), exist_ok=True)
+    created = []
+    with Image.open(os.path.join(upload_folder, filename)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+        for variant, size in app.config['IMAGE_VARIANTS'].items():
+            target = os.path.join(upload_folder, variant_name(filename, variant))
+            if os.path.exists(target):
+                continue
+            image = original.copy()
+            image.thumbnail(size, Image.LANCZOS)
+            # Write to a temporary file first so a half written variant is never served
+            image.save(f'{target}.tmp', 'WEBP', quality=80, method=4)
+            os.replace(f'{target}.tmp', target)
+            created.append(variant)
+    return created
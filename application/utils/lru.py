@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+class SizedLRU:
+    """
+    Least recently used cache bounded by the total size of its values (as given to set) and by the age of its entries.
+    Thread safe. Values are shared between the callers, they must not be modified.
+    """
+
+    def __init__(self, max_bytes, timeout):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.bytes = 0
+        self.entries = OrderedDict()  # key: (value, size, expires at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # (found, value), so None can be cached
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[0]
+
+    def set(self, key, value, size, timeout=None):
+        # timeout can only shorten the lifetime of the entry
+        if size > self.max_bytes:
+            return
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.monotonic() + timeout)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        self.bytes -= self.entries.pop(key)[1]
+
+    def __len__(self):
+        return len(self.entries)
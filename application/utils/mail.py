@@ -1,30 +1,139 @@
+import logging
+import random
+import smtplib
+import time
 from application.instances import mail, app
-from flask_mail import Message
+from flask_mail import Message, BadHeaderError
+
+ATTACHMENT_NAMES = {
+    "application/pdf": "{}_report.pdf",
+    "application/x-zip": "{}_exported.zip",
+    "text/csv": "{}_data.csv",
+}
+
+# A mail as it is queued to the mail tasks (JSON serializable, the attachment is its content)
+def mailMessage(RECEIVER_ADDRESS, SUBJECT, MESSAGE, ATTACHMENT=None, mime_type="application/pdf"):
+    # Attachments, given as the path of the file or its content (bytes)
+    if ATTACHMENT and not isinstance(ATTACHMENT, bytes):
+        with app.open_resource(ATTACHMENT) as fp:
+            ATTACHMENT = fp.read()
+    return {'to': RECEIVER_ADDRESS, 'subject': SUBJECT, 'message': MESSAGE, 'attachment': ATTACHMENT or None, 'mime_type': mime_type, 'attempt': 0}
+
+def buildMessage(message):
+    msg = Message(
+        recipients=[message['to']],
+        sender=app.config['MAIL_USERNAME'],
+        subject=message['subject']
+    )
+
+    # Attach HTML content
+    if message['mime_type'] == "text/html":
+        msg.html = message['message']
+    else:
+        msg.body = message['message']
+
+    if message['attachment'] and message['mime_type'] in ATTACHMENT_NAMES:
+        msg.attach(ATTACHMENT_NAMES[message['mime_type']].format(message['to']), message['mime_type'], message['attachment'])
+    return msg
 
 def sendMail(RECEIVER_ADDRESS, SUBJECT, MESSAGE, ATTACHMENT=None, mime_type="application/pdf"):
+    # Sends one mail right away, mails sent in loops go through MailQueue instead
     try:
-        msg = Message(
-            recipients=[RECEIVER_ADDRESS],
-            sender=app.config['MAIL_USERNAME'],
-            subject=SUBJECT
-        )
-
-        # Attach HTML content
-        if mime_type == "text/html":
-            msg.html = MESSAGE
-
-        # Attachments
-        if ATTACHMENT:
-            with app.open_resource(ATTACHMENT) as fp:
-                if mime_type == "application/pdf":
-                    msg.attach(f"{RECEIVER_ADDRESS}_report.pdf", mime_type, fp.read())
-                elif mime_type == "application/x-zip":
-                    msg.attach(f"{RECEIVER_ADDRESS}_exported.zip", mime_type, fp.read())
-                elif mime_type == "text/csv":
-                    msg.attach(f"{RECEIVER_ADDRESS}_data.csv", mime_type, fp.read())
-
-        mail.send(msg)
+        mail.send(buildMessage(mailMessage(RECEIVER_ADDRESS, SUBJECT, MESSAGE, ATTACHMENT, mime_type)))
         return True
     except Exception as e:
         print("Error", e)
-        return False
\ No newline at end of file
+        return False
+
+
+# ------------------------ Batched delivery ------------------------
+
+def isPermanentFailure(error):
+    # Errors that will not go away by sending the message again
+    if isinstance(error, (AssertionError, BadHeaderError)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+def _close(connection):
+    try:
+        connection.__exit__(None, None, None)
+    except OSError:
+        pass
+
+def deliver(messages):
+    """
+    Sends the messages over one SMTP connection (reopened if the server drops it), at most MAIL_RATE_LIMIT a second.
+    Returns (number sent, messages to retry, number failed for good).
+    """
+    rate = app.config['MAIL_RATE_LIMIT']
+    sent, retry, failed = 0, [], 0
+    connection = None
+    try:
+        for index, message in enumerate(messages):
+            started = time.monotonic()
+            if connection is None:
+                try:
+                    connection = mail.connect().__enter__()
+                except Exception as e:
+                    logging.info(f'Could not connect to the mail server, {len(messages) - index} mails will be retried: {e}')
+                    retry.extend(messages[index:])
+                    break
+            try:
+                connection.send(buildMessage(message))
+                sent += 1
+            except Exception as e:
+                if isPermanentFailure(e):
+                    logging.info(f'Mail to {message["to"]} failed: {e}')
+                    failed += 1
+                else:
+                    logging.info(f'Mail to {message["to"]} will be retried: {e}')
+                    retry.append(message)
+                # The connection is reopened for the next message if it was lost (SMTP errors are OSErrors too)
+                if isinstance(e, smtplib.SMTPServerDisconnected) or (isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)):
+                    _close(connection)
+                    connection = None
+            if rate:
+                time.sleep(max(0, 1 / rate - (time.monotonic() - started)))
+    finally:
+        if connection is not None:
+            _close(connection)
+    return sent, retry, failed
+
+def retryDelay(attempt):
+    # Exponential backoff with jitter, so the retried messages do not all hit the server at once
+    delay = app.config['MAIL_RETRY_BACKOFF'] * 2 ** attempt
+    return delay / 2 + random.random() * delay / 2
+
+
+class MailQueue:
+    """
+    Queues the mails to the sendMailBatch task, MAIL_BATCH_SIZE mails at a time. Every batch is sent over one SMTP
+    connection by a worker of the mail queue. Used as a context manager, the last (partial) batch is queued on exit.
+    """
+
+    def __init__(self):
+        self.batch = []
+        self.queued = 0
+
+    def add(self, RECEIVER_ADDRESS, SUBJECT, MESSAGE, ATTACHMENT=None, mime_type="application/pdf"):
+        self.batch.append(mailMessage(RECEIVER_ADDRESS, SUBJECT, MESSAGE, ATTACHMENT, mime_type))
+        if len(self.batch) >= app.config['MAIL_BATCH_SIZE']:
+            self.flush()
+        return True
+
+    def flush(self):
+        from application.tasks import sendMailBatch
+        if self.batch:
+            sendMailBatch.delay(self.batch)
+            self.queued += len(self.batch)
+            self.batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
@@ -1,32 +1,157 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 from json import dumps
-from httplib2 import Http
+from httplib2 import Http, HttpLib2Error
 import os
 from dotenv import load_dotenv
+from application.instances import app
 
 load_dotenv(".env")
 
-def google_chat_reminder(users):
-    try: 
-        url = os.getenv('GOOGLE_CHAT_WEBHOOK_URL')
-        for user in users:
-            app_message = {
-'text': f"""Hi {user.username}, 
+REMINDER = """Hi {username},
 We hope you're doing well! We've noticed that you haven't placed any orders in our app in the last 24 hours. We have a wide selection of fresh products and exciting deals waiting for you. Don't miss out!
 Remember, we're here to make your shopping experience easy and convenient. Visit us today and let's make your next shopping trip a great one!
 
 Best regards,
 The MyBasket Team
 """
-                }
-            message_headers = {'Content-Type': 'application/json; charset=UTF-8'}
-            http_obj = Http()
-            response = http_obj.request(
-                uri=url,
-                method='POST',
-                headers=message_headers,
-                body=dumps(app_message),
-            )
-        return True
-    except Exception as e:
-        print("Error",e)
-        return False
\ No newline at end of file
+
+MESSAGE_HEADERS = {'Content-Type': 'application/json; charset=UTF-8'}
+
+def reminder_message(usernames):
+    # One text message for a single user, one card naming every user when they are coalesced
+    if len(usernames) == 1:
+        return {'text': REMINDER.format(username=usernames[0])}
+    return {'cardsV2': [{'cardId': 'dailyReminder', 'card': {
+        'header': {'title': 'Daily Reminder', 'subtitle': 'MyBasket Store'},
+        'sections': [{'widgets': [{'textParagraph': {'text': REMINDER.format(username=', '.join(usernames))}}]}],
+    }}]}
+
+def reminder_messages(users, coalesce=None):
+    # Yields (number of users, message), users are read as they are yielded so they can be streamed
+    users = iter(users)
+    while True:
+        usernames = [user.username for user in islice(users, coalesce or 1)]
+        if not usernames:
+            return
+        yield len(usernames), reminder_message(usernames)
+
+
+class ChatDispatcher:
+    """
+    Posts messages to a Google Chat webhook from CHAT_WEBHOOK_CONCURRENCY threads (greenlets in the gevent worker).
+    Every thread keeps its own connection to the webhook alive. A message failing with a 429, a 5xx or a connection
+    error is retried with backoff, a 429 pauses every thread for its Retry-After. Delivery stats are kept in `stats`.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.concurrency = app.config['CHAT_WEBHOOK_CONCURRENCY']
+        self.max_retries = app.config['CHAT_WEBHOOK_MAX_RETRIES']
+        self.backoff = app.config['CHAT_WEBHOOK_BACKOFF']
+        self.timeout = app.config['CHAT_WEBHOOK_TIMEOUT']
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.paused_until = 0
+        self.stats = {'messages': 0, 'users': 0, 'sent': 0, 'failed': 0, 'retries': 0, 'rate_limited': 0, 'seconds': 0}
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def http(self):
+        # httplib2 clients are not thread safe, every thread has its own
+        if getattr(self.local, 'http', None) is None:
+            self.local.http = Http(timeout=self.timeout)
+        return self.local.http
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_if_paused(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def retry_after(self, response, attempt):
+        # Retry-After is given in seconds by Google Chat, the backoff is used when it is missing (or a date)
+        try:
+            return min(float(response['retry-after']), 60)
+        except (KeyError, ValueError):
+            return self.delay(attempt)
+
+    def delay(self, attempt):
+        delay = self.backoff * 2 ** attempt
+        return delay / 2 + random.random() * delay / 2
+
+    def post(self, message):
+        # Returns True once the message is accepted
+        body = dumps(message)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.count(retries=1)
+            self.wait_if_paused()
+            try:
+                response, _ = self.http().request(uri=self.url, method='POST', headers=MESSAGE_HEADERS, body=body)
+            except (HttpLib2Error, OSError) as e:
+                logging.info(f'Google Chat webhook unreachable: {e}')
+                # The connection is dropped, the next attempt opens a new one
+                self.local.http = None
+                delay = self.delay(attempt)
+            else:
+                if response.status < 300:
+                    return True
+                if response.status == 429:
+                    self.count(rate_limited=1)
+                    delay = self.retry_after(response, attempt)
+                    self.pause(delay)
+                elif response.status < 500:
+                    logging.info(f'Google Chat webhook refused the message: {response.status}')
+                    return False
+                else:
+                    delay = self.delay(attempt)
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        return False
+
+    def send(self, users, message):
+        try:
+            sent = self.post(message)
+        except Exception as e:
+            logging.info(f'Error in sending the Google Chat reminder: {e}')
+            sent = False
+        self.count(sent=users if sent else 0, failed=0 if sent else users)
+
+    def dispatch(self, messages):
+        # messages yields (number of users, message). At most twice the concurrency are read ahead.
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = set()
+            for users, message in messages:
+                if len(pending) >= 2 * self.concurrency:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                self.count(messages=1, users=users)
+                pending.add(pool.submit(self.send, users, message))
+        self.stats['seconds'] = round(time.monotonic() - started, 3)
+        return self.stats
+
+
+def google_chat_reminder(users, coalesce=None):
+    """
+    Reminds the users on Google Chat, one message per user or one card for every `coalesce` users
+    (CHAT_WEBHOOK_COALESCE by default). Returns the delivery stats of the run.
+    """
+    url = os.getenv('GOOGLE_CHAT_WEBHOOK_URL')
+    dispatcher = ChatDispatcher(url)
+    if not url:
+        logging.info('GOOGLE_CHAT_WEBHOOK_URL is not set, no reminder sent')
+        return dispatcher.stats
+    if coalesce is None:
+        coalesce = app.config['CHAT_WEBHOOK_COALESCE']
+    return dispatcher.dispatch(reminder_messages(users, coalesce))
@@ -0,0 +1,76 @@
+"""
+Latency of a slow cached read across its expiry, with concurrent readers:
+- plain: cache.get / cache.set with a ttl, as the aggregates were cached before (every reader recomputes on expiry)
+- hot: cached_by_tags(hot=True), single flight recompute, stale value served meanwhile, early refresh
+
+Needs redis (the cache of the app). Run from the repository root: python -m benchmarks.cache_stampede [readers] [seconds]
+"""
+import sys
+import threading
+import time
+from main import app
+from application.instances import cache
+from application.cachetags import cached_by_tags
+
+TTL = 2
+COMPUTE_TIME = 0.3
+computations = {'plain': 0, 'hot': 0}
+
+
+def slow_aggregate(name):
+    computations[name] += 1
+    time.sleep(COMPUTE_TIME)
+    return list(range(1000))
+
+def plain():
+    value = cache.get('benchmark:plain')
+    if value is None:
+        value = slow_aggregate('plain')
+        cache.set('benchmark:plain', value, timeout=TTL)
+    return value
+
+@cached_by_tags('benchmark', timeout=TTL, hot=True)
+def hot():
+    return slow_aggregate('hot')
+
+
+def run(read, readers, seconds):
+    latencies = []
+    started = time.monotonic()
+
+    def reader():
+        with app.app_context():
+            while time.monotonic() - started < seconds:
+                begin = time.monotonic()
+                read()
+                latencies.append((begin - started, time.monotonic() - begin))
+                time.sleep(0.01)
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def report(name, latencies, seconds):
+    print(f'{name}: {computations[name]} computations, {len(latencies)} reads')
+    print('  second   p50 ms   p99 ms   max ms')
+    for second in range(seconds):
+        window = sorted(latency for at, latency in latencies if second <= at < second + 1)
+        if window:
+            print(f'  {second:6d} {window[len(window) // 2] * 1000:8.1f} {window[int(len(window) * 0.99)] * 1000:8.1f} {window[-1] * 1000:8.1f}')
+
+
+def main():
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    for name, read in (('plain', plain), ('hot', hot)):
+        # Warmed, so the run starts from a cached value and only crosses expiries
+        with app.app_context():
+            read()
+        computations[name] = 0
+        report(name, run(read, readers, seconds), seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Mails per second sent to a local SMTP sink:
+- per mail: mail.send for every mail, one SMTP connection (and handshake) per mail (as sendMail did in loops)
+- batched: application.utils.mail.deliver, MAIL_BATCH_SIZE mails over one connection
+
+The sink answers like a real server after a delay of `latency` seconds per command, and may refuse a part of
+the mails with a temporary (4xx) error, which deliver() hands back for retrying. Run from the repository root:
+python -m benchmarks.mail_throughput [mails] [latency] [temporary failure rate]
+"""
+import random
+import socketserver
+import sys
+import threading
+import time
+from application.instances import app, mail
+from application.config import LocalDevelopmentConfig
+from application.utils.mail import mailMessage, buildMessage, deliver
+
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    latency = 0.0
+    failure_rate = 0.0
+
+    def reply(self, line):
+        time.sleep(self.latency)
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 sink')
+            elif command.startswith('RCPT') and random.random() < self.failure_rate:
+                self.reply('451 try again later')
+            elif command.startswith('DATA'):
+                self.reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.reply('250 queued')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_messages(count):
+    return [mailMessage(f'customer{i}@yopmail.com', 'Daily Reminder', f'<p>Hello customer{i}</p>', mime_type='text/html') for i in range(count)]
+
+def per_mail(messages):
+    failed = 0
+    for message in messages:
+        try:
+            mail.send(buildMessage(message))
+        except Exception:
+            failed += 1
+    return len(messages) - failed, failed
+
+def batched(messages):
+    size = app.config['MAIL_BATCH_SIZE']
+    sent = retry = 0
+    for start in range(0, len(messages), size):
+        batch_sent, batch_retry, _ = deliver(messages[start:start + size])
+        sent += batch_sent
+        retry += len(batch_retry)
+    return sent, retry
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    SMTPSink.latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.002
+    SMTPSink.failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server = Server(('127.0.0.1', 0), SMTPSink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    app.config.from_object(LocalDevelopmentConfig)
+    app.config.update(
+        MAIL_SERVER='127.0.0.1', MAIL_PORT=server.server_address[1], MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+        MAIL_USERNAME='store@mybasket.com', MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False, MAIL_DEBUG=False, MAIL_RATE_LIMIT=None,
+    )
+    mail.init_app(app)
+    with app.app_context():
+        messages = make_messages(count)
+        for name, send in (('per mail', per_mail), (f'batched ({app.config["MAIL_BATCH_SIZE"]})', batched)):
+            started = time.perf_counter()
+            sent, not_sent = send(messages)
+            seconds = time.perf_counter() - started
+            print(f'{name:16s} {count / seconds:8.1f} mails/s  sent {sent}, not sent {not_sent}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Concurrent checkouts of one SKU: `buyers` customers, each with `quantity` units of the same product in their cart,
+place their orders at the same time through POST /place-order. The product starts with `stock` units.
+
+Stock must never be oversold: the orders placed (201) must add up to at most the initial stock, the others must be
+refused (409), and the stock left plus the units ordered must equal the initial stock. Exits with 1 otherwise.
+
+Creates its own product and customers, run it against a throwaway database (DATABASE_URI) and redis.
+Run from the repository root: python -m benchmarks.oversell [buyers] [stock] [quantity]
+"""
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from main import app
+from application.instances import db
+from application.models import User, Products, Category, Cart, ItemsOrdered
+from application.tokens import create_user_token
+
+
+def setup(buyers, stock, quantity):
+    run = uuid.uuid4().hex[:8]
+    manager = User.query.filter_by(role_id=2).first()
+    category = Category.query.first()
+    product = Products(
+        title=f'Oversell {run}', description='Concurrent checkouts', price=10, unit='kg', discount=0,
+        initialStock=stock, stock=stock, category_id=category.id, store_owner_id=manager.id, approved=True,
+    )
+    db.session.add(product)
+    customers = [User(username=f'buyer-{run}-{i}', password='-', email=f'buyer-{run}-{i}@yopmail.com', role_id=1, approved=True) for i in range(buyers)]
+    db.session.add_all(customers)
+    db.session.flush()
+    db.session.add_all([Cart(customer_id=customer.id, product_id=product.id, quantity=quantity) for customer in customers])
+    db.session.commit()
+    return product.id, [{'Authorization': 'Bearer ' + create_user_token(customer)} for customer in customers]
+
+def checkout(headers):
+    # Every buyer waits for the others, so the orders are placed at the same time
+    codes = Counter()
+    barrier = threading.Barrier(len(headers))
+    lock = threading.Lock()
+
+    def buy(header):
+        client = app.test_client()
+        barrier.wait()
+        status = client.post('/place-order', headers=header, json={'addressDetails': 'Oversell'}).status_code
+        with lock:
+            codes[status] += 1
+    threads = [threading.Thread(target=buy, args=(header,)) for header in headers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return codes
+
+
+def main():
+    buyers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    stock = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    quantity = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    with app.app_context():
+        product_id, headers = setup(buyers, stock, quantity)
+    started = time.perf_counter()
+    codes = checkout(headers)
+    seconds = time.perf_counter() - started
+    with app.app_context():
+        left = db.session.get(Products, product_id).stock
+        ordered = db.session.query(db.func.coalesce(db.func.sum(ItemsOrdered.quantity), 0)).filter(ItemsOrdered.item_id == product_id).scalar()
+    expected = min(buyers, stock // quantity)
+    print(f'{buyers} buyers of {quantity} unit(s), stock {stock}: {dict(codes)} in {seconds:.2f}s, stock left {left}, units ordered {ordered}')
+    failures = []
+    if codes[201] != expected:
+        failures.append(f'{codes[201]} orders placed, expected {expected}')
+    if codes[409] != buyers - expected:
+        failures.append(f'{codes[409]} orders refused, expected {buyers - expected}')
+    if left < 0 or left + ordered != stock or ordered != codes[201] * quantity:
+        failures.append(f'stock oversold or lost: {left} left + {ordered} ordered != {stock}')
+    for failure in failures:
+        print('FAILED:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+PDFs per second of the monthly report:
+- per report: the template read and parsed, a new weasyprint.HTML written to a file for every report (as create_pdf did)
+- warm: one Renderer (template, stylesheet and fonts loaded once) rendering to memory in this process
+- pool: the renderer processes of application.pdfs
+
+Needs WeasyPrint and its system libraries (pango). Run from the repository root:
+python -m benchmarks.pdf_render [reports] [processes]
+"""
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import wait
+from jinja2 import Template
+from application.instances import app
+from application.config import LocalDevelopmentConfig
+from application.pdfs import TEMPLATES, Renderer, renderer_pool, submit_pdf
+
+
+def make_report(i):
+    return {
+        'username': f'customer{i}', 'email': f'customer{i}@yopmail.com', 'month': 'November', 'totalExpenditure': 1234.5,
+        'orders': [
+            {'id': order, 'status': 'Delivered', 'created_at': '09 November 2023', 'total': 246.9,
+             'items': [{'title': f'Product {item}', 'quantity': 2, 'price': 61.72} for item in range(4)]}
+            for order in range(5)
+        ],
+    }
+
+def per_report(reports, folder):
+    from weasyprint import HTML
+    for data in reports:
+        with open(os.path.join(TEMPLATES, 'monthlyReport.html')) as file:
+            message = Template(file.read()).render(data=data)
+        file_name = os.path.join(folder, str(uuid.uuid4()) + '.pdf')
+        HTML(string=message).write_pdf(target=file_name)
+        os.remove(file_name)
+
+def warm(reports):
+    renderer = Renderer('monthlyReport.html')
+    renderer.render(reports[0])
+    started = time.perf_counter()
+    for data in reports:
+        renderer.render(data)
+    return time.perf_counter() - started
+
+def pool(reports):
+    # The processes are started (and warmed) before timing
+    wait([submit_pdf(reports[0]) for _ in range(app.config['PDF_RENDER_PROCESSES'])])
+    started = time.perf_counter()
+    wait([submit_pdf(data) for data in reports])
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    app.config.from_object(LocalDevelopmentConfig)
+    app.config['PDF_RENDER_PROCESSES'] = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    reports = [make_report(i) for i in range(count)]
+    folder = os.path.join(os.path.dirname(__file__), '..', 'application', 'static', 'PDF')
+    started = time.perf_counter()
+    per_report(reports, folder)
+    results = [('per report', time.perf_counter() - started), ('warm', warm(reports))]
+    results.append((f'pool ({app.config["PDF_RENDER_PROCESSES"]} processes)', pool(reports)))
+    renderer_pool().shutdown()
+    for name, seconds in results:
+        print(f'{name:24s} {count / seconds:8.1f} PDFs/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Compares the compiled serializer (application.serializers) with flask_restful.marshal + json on a list of products.
+
+Run from the repository root: python -m benchmarks.serialization [number of products]
+"""
+import json
+import sys
+import timeit
+from datetime import datetime
+from flask_restful import marshal
+from application.instances import app
+from application.models import User, Products
+from application.serializers import fast_marshal, dumps, ENCODER
+from application.utilities import products_resource_fields
+
+
+def make_products(count):
+    owner = User(id=1, username='manager', email='manager@yopmail.com')
+    return [
+        Products(id=i, title=f'Product {i}', description='Fresh and organic ' * 10, price=10.0 + i % 100, image=None,
+                 store_owner_id=1, store_owner=owner, category_id=1 + i % 5, visibility=True, discount=5.0,
+                 initialStock=100, stock=50 + i % 50, unit='kg', manufacture_date=datetime(2023, 11, 1),
+                 expiry_date=datetime(2024, 11, 1), average_rating=4.5)
+        for i in range(count)
+    ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    products = make_products(count)
+    with app.app_context():
+        assert fast_marshal(products, products_resource_fields) == marshal(products, products_resource_fields)
+        runs = 5
+        marshal_time = min(timeit.repeat(lambda: json.dumps(marshal(products, products_resource_fields)).encode(), number=1, repeat=runs))
+        fast_time = min(timeit.repeat(lambda: dumps(fast_marshal(products, products_resource_fields)), number=1, repeat=runs))
+    print(f'{count} products, best of {runs}')
+    print(f'marshal + json.dumps:        {marshal_time * 1000:8.1f} ms')
+    print(f'fast_marshal + {ENCODER + ".dumps":<13}{fast_time * 1000:8.1f} ms')
+    print(f'speedup:                     {marshal_time / fast_time:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Google Chat reminders per second posted to a local webhook stub:
+- serial: one POST per user with a new httplib2.Http (and connection) for every post (as google_chat_reminder did)
+- dispatcher: application.utils.webhook_reminder.ChatDispatcher, CHAT_WEBHOOK_CONCURRENCY posts at a time
+- coalesced: the dispatcher with CHAT_WEBHOOK_COALESCE users per card
+
+The stub answers after `latency` seconds and rate limits a part of the posts with a 429 (Retry-After: 0).
+It counts the connections opened. Run from the repository root:
+python -m benchmarks.webhook_dispatch [users] [latency] [rate limited part] [concurrency]
+"""
+import random
+import sys
+import threading
+import time
+from json import dumps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from httplib2 import Http
+from application.instances import app
+from application.config import LocalDevelopmentConfig
+from application.utils.webhook_reminder import ChatDispatcher, MESSAGE_HEADERS, REMINDER, reminder_messages
+
+
+class WebhookStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffered, so the headers and the body of an answer are written at once (as a real server does)
+    wbufsize = 8192
+    latency = 0.0
+    rate_limited = 0.0
+    connections = 0
+    received = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            WebhookStub.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.latency)
+        if random.random() < self.rate_limited:
+            self.answer(429, {'Retry-After': '0'})
+            return
+        with self.lock:
+            WebhookStub.received += 1
+        self.answer(200)
+
+    def answer(self, status, headers={}):
+        body = b'{}'
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serial(url, users):
+    sent = 0
+    for user in users:
+        response, _ = Http().request(uri=url, method='POST', headers=MESSAGE_HEADERS, body=dumps({'text': REMINDER.format(username=user.username)}))
+        sent += response.status == 200
+    return {'sent': sent}
+
+def dispatcher(url, users, coalesce=None):
+    return ChatDispatcher(url).dispatch(reminder_messages(users, coalesce))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    WebhookStub.latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    WebhookStub.rate_limited = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    app.config.from_object(LocalDevelopmentConfig)
+    if len(sys.argv) > 4:
+        app.config['CHAT_WEBHOOK_CONCURRENCY'] = int(sys.argv[4])
+    app.config['CHAT_WEBHOOK_BACKOFF'] = 0.05
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/webhook'
+    users = [SimpleNamespace(username=f'customer{i}') for i in range(count)]
+    runs = [
+        ('serial', lambda: serial(url, users)),
+        (f'dispatcher ({app.config["CHAT_WEBHOOK_CONCURRENCY"]})', lambda: dispatcher(url, users)),
+        ('coalesced (50)', lambda: dispatcher(url, users, coalesce=50)),
+    ]
+    for name, run in runs:
+        WebhookStub.connections = WebhookStub.received = 0
+        started = time.perf_counter()
+        stats = run()
+        seconds = time.perf_counter() - started
+        print(f'{name:18s} {count / seconds:8.1f} users/s  {WebhookStub.connections:4d} connections  {stats}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
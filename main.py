@@ -14,89 +14,58 @@ app.logger.addHandler(handler)
 app.logger.setLevel(logging.DEBUG)
 
 
-import redis
 from application.models import User
+from application.tokens import revoke_token, is_token_revoked
+from application.instances import db
 from flask_jwt_extended import get_jwt, jwt_required
 
+# The user is loaded once per request (by primary key) and reused as current_user.
+# Role checks are done from the token claims, so the role is not loaded with it.
 @jwt.user_lookup_loader
 def user_loader(jwt_header, jwt_payload):
-    identity = jwt_payload["sub"]
-    # Load the user based on the provided identity
-    user = User.query.filter_by(username=identity).first()
-    if user:
-        return user
-    return None
-
-# Setup redis connection for storing the blocklisted tokens.
-jwt_redis_blocklist = redis.StrictRedis(
-    host="localhost", port=6379, db=0, decode_responses=True
-)
-
-# Callback function to check if a JWT exists in the redis blocklist
+    return db.session.get(User, jwt_payload["id"])
+
+# Callback function to check if a JWT exists in the redis blocklist or was issued before the user's tokens were revoked
 @jwt.token_in_blocklist_loader
 def check_if_token_is_revoked(jwt_header, jwt_payload: dict):
-    jti = jwt_payload["jti"]
-    token_in_redis = jwt_redis_blocklist.get(jti)
-    return token_in_redis is not None
+    return is_token_revoked(jwt_payload)
 
 # Endpoint for revoking the current users access token. Save the JWTs unique
 # identifier (jti) in redis. Also set a Time to Live (TTL)  when storing the JWT
 # so that it will automatically be cleared out of redis after the token expires.
+# The jti is also published to the revoked token filters of all the workers.
 @app.route("/logout", methods=["DELETE"])
 @jwt_required()
 def logout():
-    jti = get_jwt()["jti"]
-    jwt_redis_blocklist.set(jti, "", ex=timedelta(hours=24))
+    revoke_token(get_jwt()["jti"])
     return jsonify(msg="Access token revoked")
 
 
 ########## Exporting data to CSV (User Triggered async job) #########
-import csv    
-from flask import send_file
-@celery.task(name="generate_csv")
-def generate_csv(managerId):
-    try:
-        manager = User.query.filter_by(id=managerId).first()
-        products = Products.query.filter_by(store_owner_id=managerId).all()
-        csv_data = {}
-        for product in products:
-            csv_data[product.id] = {
-                'ID': product.id,
-                'Title': product.title,
-                'Description': product.description,
-                'MRP': product.price,
-                'Discount %': product.discount,
-                'Discounted Price': product.price * (1 - product.discount / 100),
-                'Unit (measured in)': product.unit,
-                'Initial Stock': product.initialStock,
-                'Stock Left': product.stock,
-                'Items Sold': product.initialStock - product.stock,
-                'Manufacture Date': product.manufacture_date,
-                'Expiry Date': product.expiry_date,
-                'Category': product.category.name,
-                'Average Rating': 'No ratings yet' if product.average_rating == 0.0 else product.average_rating,
-                'Visibility to customers (Ask admin for toggling this on/off)': 'Yes' if product.visibility else 'No',
-            }
-        file_path = 'application/static/csv'
-        filename = 'data'
-        with open(f'{file_path}/{filename}.csv', "w") as file:
-            myWriter = csv.writer(file)
-            headerRow = True
-            for row in csv_data.values():
-                if headerRow:
-                    myWriter.writerow(row.keys())
-                    headerRow = False
-                myWriter.writerow(row.values())
-            file.close()
-        return True
-    except Exception as e:
-        print("Error",e)
-        return False
+import os
+from datetime import datetime
+from flask import Response, request
+from flask_jwt_extended import current_user
+from application.exports import export_products_csv, export_bundle, export_path, stream_file
+from application.roles import owner_required
+from application.utilities import parseDateArg
+from application.utils.mail import sendMail
+# The export is streamed to a file of its own, the progress (rows done / total) is reported in the task state.
+# The user who asked for it is recorded in the progress and the result, only they can follow and download it.
+@celery.task(name="generate_csv", bind=True)
+def generate_csv(self, managerId, compress=False, requested_by=None):
+    def progress(done, total):
+        self.update_state(state='PROGRESS', meta={'done': done, 'total': total, 'requested_by': requested_by})
+    return dict(export_products_csv(managerId, self.request.id, compress, progress), requested_by=requested_by)
 
 @app.route('/export-data/<int:managerId>', methods=['GET'])
 @jwt_required()
+@owner_required
 def export_data(managerId):
-    res = generate_csv.delay(managerId)
+    # Store managers can only export their own data
+    if current_user.role_id != 3 and current_user.id != managerId:
+        return {'message': 'Permission denied'}, 403
+    res = generate_csv.delay(managerId, request.args.get('compress') == 'gzip', current_user.id)
     if res:
         return jsonify({'message':'CSV generation request is in progress',
                 "taskId": res.id,
@@ -105,15 +74,61 @@ def export_data(managerId):
     else:
         return {'message': 'Something went wrong'}, 500
 
+# Bundle of the products, orders, items ordered and feedback of the store owner as CSV files of a ZIP archive,
+# downloaded from /check-export-status or mailed to the user who asked for it
+@celery.task(name="generate_export_bundle", bind=True)
+def generate_export_bundle(self, managerId, starting_date=None, ending_date=None, email=None, requested_by=None):
+    def progress(name, done, total):
+        self.update_state(state='PROGRESS', meta={'file': name, 'done': done, 'total': total, 'requested_by': requested_by})
+    result = export_bundle(managerId, self.request.id,
+                           starting_date and datetime.fromisoformat(starting_date), ending_date and datetime.fromisoformat(ending_date), progress)
+    result['requested_by'] = requested_by
+    if email:
+        path = os.path.abspath(export_path(result['file']))
+        result['mailed'] = sendMail(email, 'MyBasket Data Export', 'Please find the attached data export', ATTACHMENT=path, mime_type='application/x-zip')
+    return result
+
+@app.route('/export-bundle/<int:managerId>', methods=['GET'])
+@jwt_required()
+@owner_required
+def export_bundle_data(managerId):
+    # Store managers can only export their own data
+    if current_user.role_id != 3 and current_user.id != managerId:
+        return {'message': 'Permission denied'}, 403
+    starting_date = parseDateArg('starting_date', None)
+    ending_date = parseDateArg('ending_date', None, end_of_day=True)
+    email = current_user.email if request.args.get('deliver') == 'mail' else None
+    res = generate_export_bundle.delay(managerId, starting_date and starting_date.isoformat(), ending_date and ending_date.isoformat(), email, current_user.id)
+    return jsonify({'message':'Export request is in progress',
+            "taskId": res.id,
+            "state": res.state})
+
 @app.route("/check-export-status/<task_id>")
+@jwt_required()
 def check_csv_status(task_id):
     task = generate_csv.AsyncResult(task_id)
+    # A finished export returns its file details, anything else (e.g. the result of another task id) is not an export
+    if task.state == 'SUCCESS' and not isinstance(task.result, dict):
+        return {'message': 'Export failed or in an unknown state'}, 500
+    # Exports are only followed and downloaded by the user who asked for them (or an admin)
+    info = task.info if task.state in ('SUCCESS', 'PROGRESS') else None
+    if isinstance(info, dict) and info.get('requested_by') != current_user.id and current_user.role_id != 3:
+        return {'message': 'Permission denied'}, 403
     if task.state == 'SUCCESS':
-        return send_file('static/csv/data.csv', as_attachment=True, download_name='exported_data.csv'),200
-    elif task.state in ['PENDING', 'PROGRESS']:
+        path = export_path(task.result['file'])
+        if not os.path.exists(path):
+            return {'message': 'The export has expired, please export the data again'}, 410
+        # Streamed in chunks, the file is never read into memory
+        return Response(stream_file(path, app.config['EXPORT_CHUNK_SIZE']), mimetype=task.result['mimetype'], headers={
+            'Content-Disposition': f'attachment; filename={task.result["download_name"]}',
+            'Content-Length': str(os.path.getsize(path)),
+        })
+    elif task.state in ['PENDING', 'STARTED']:
         return {'status': task.state}, 202
+    elif task.state == 'PROGRESS':
+        return {'status': task.state, **task.info}, 202
     else:
-        return {'message': 'CSV generation failed or in an unknown state'}, 500
+        return {'message': 'Export failed or in an unknown state'}, 500
 
 
 ####### Registering the API endpoints #######
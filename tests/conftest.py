@@ -0,0 +1,36 @@
+"""
+The tests run the app on a throwaway SQLite database (seeded with the sample data on startup) and need redis on
+localhost:6379 like the app does, the cache is cleared by some tests. Run from the repository root: python -m pytest
+"""
+import os
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+
+from main import app as flask_app
+from application.models import User
+from application.tokens import create_user_token
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.testing = True
+    return flask_app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def auth(app):
+    # Authorization header of the user
+    def headers(user):
+        if isinstance(user, str):
+            user = User.query.filter_by(username=user).one()
+        return {'Authorization': 'Bearer ' + create_user_token(user)}
+    return headers
@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.mark.parametrize('url, message', [
+    ('/categories/2/products?after=abc', 'Invalid cursor'),
+    ('/track-orders/2?after=eyJhIjogMX0', 'Invalid cursor'),
+])
+def test_invalid_cursor_of_plain_routes_is_json(client, auth, url, message):
+    response = client.get(url, headers=auth('customer'))
+    assert response.status_code == 400
+    assert response.is_json
+    assert response.json == {'message': message}
+
+def test_invalid_cursor_of_resources_is_json(client, auth):
+    response = client.get('/products?after=abc', headers=auth('customer'))
+    assert response.status_code == 400
+    assert response.json['message'] == 'Invalid cursor'
+
+@pytest.mark.parametrize('user, url, message', [
+    ('admin', '/summary/sales?starting_date=garbage', 'Invalid starting_date, expected an ISO 8601 date'),
+    ('admin', '/summary/sales?granularity=year', 'Invalid granularity, expected one of day, week, month'),
+    ('admin', '/summary/categories?ending_date=2024-13-01', 'Invalid ending_date, expected an ISO 8601 date'),
+    ('manager', '/summary/sales?ending_date=yesterday', 'Invalid ending_date, expected an ISO 8601 date'),
+    ('manager', '/summary/categories?granularity=hour', 'Invalid granularity, expected one of day, week, month'),
+    ('manager', '/manager/orders?starting_date=2024-02-30', 'Invalid starting_date, expected an ISO 8601 date'),
+])
+def test_invalid_dates_and_granularity_are_json(client, auth, user, url, message):
+    response = client.get(url, headers=auth(user))
+    assert response.status_code == 400
+    assert response.is_json
+    assert response.json == {'message': message}
@@ -0,0 +1,25 @@
+import pytest
+from application.cachetags import cached_by_tags
+from application.instances import cache
+
+calls = []
+
+@cached_by_tags('orders')
+def missing_order(order_id):
+    calls.append(order_id)
+    return None
+
+@cached_by_tags('orders', hot=True)
+def missing_hot_order(order_id):
+    calls.append(order_id)
+    return None
+
+
+@pytest.mark.parametrize('fn', [missing_order, missing_hot_order])
+def test_none_is_cached(app, fn):
+    calls.clear()
+    with app.app_context():
+        cache.clear()
+        assert fn(404) is None
+        assert fn(404) is None
+    assert calls == [404]
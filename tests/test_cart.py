@@ -0,0 +1,26 @@
+from sqlalchemy import event
+from application.instances import db
+from application.models import User, Products, Cart
+
+
+def test_update_cart_loads_the_products_of_the_cart_at_once(app, client, auth):
+    with app.app_context():
+        customer = User.query.filter_by(username='customer').one()
+        Cart.query.filter_by(customer_id=customer.id).delete()
+        products = [id for id, in db.session.query(Products.id).filter(Products.stock > 1).limit(6)]
+        db.session.add_all([Cart(customer_id=customer.id, product_id=id, quantity=1) for id in products[1:]])
+        db.session.commit()
+        headers = auth(customer)
+        engine = db.engine
+    queries = []
+    count = lambda *args: queries.append(args[2])
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.patch('/cart', headers=headers, json=[{'product_id': products[0], 'quantity': 2}])
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    assert sorted(item['product']['id'] for item in response.json['items']) == sorted(products)
+    assert response.json['totalQuantity'] == 2 + len(products) - 1
+    # user, products, cart, insert: no query per row of the cart
+    assert len(queries) <= 5, queries
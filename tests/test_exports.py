@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+import pytest
+import main
+from application.exports import orders_statement
+from application.instances import db
+from application.models import Products
+
+
+@pytest.mark.parametrize('result', ['done', None, ['file.csv']])
+def test_export_status_of_a_result_that_is_not_an_export(client, auth, monkeypatch, result):
+    task = SimpleNamespace(state='SUCCESS', info=result, result=result)
+    monkeypatch.setattr(main.generate_csv, 'AsyncResult', lambda task_id: task)
+    response = client.get('/check-export-status/some-task', headers=auth('customer'))
+    assert response.status_code == 500
+    assert response.json == {'message': 'Export failed or in an unknown state'}
+
+def test_export_status_of_another_user(client, auth, monkeypatch):
+    task = SimpleNamespace(state='SUCCESS', info={'requested_by': -1, 'file': 'x.csv'}, result={'requested_by': -1, 'file': 'x.csv'})
+    monkeypatch.setattr(main.generate_csv, 'AsyncResult', lambda task_id: task)
+    response = client.get('/check-export-status/some-task', headers=auth('customer'))
+    assert response.status_code == 403
+
+def test_orders_statement_groups_by_every_column_that_is_not_a_total(app):
+    with app.app_context():
+        manager_id = db.session.query(Products.store_owner_id).limit(1).scalar()
+        statement = orders_statement(manager_id)
+        grouped = {str(column) for column in statement._group_by_clauses}
+        rows = db.session.execute(statement).all()
+    assert grouped == {'Orders.id', 'User.username', 'Orders.status', 'Orders.created_at', 'Orders.updated_at'}
+    assert len(rows) == len({row[0] for row in rows})
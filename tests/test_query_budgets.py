@@ -0,0 +1,68 @@
+"""
+Query budgets (application.querybudget.query_budget, the N+1 detector) of the endpoints declaring one. Every budgeted
+endpoint is requested with the cache cleared so its queries really run, and a page size large enough that a query per
+row would go over the budget. Budgets are enforced with app.testing, going over one raises QueryBudgetExceeded.
+"""
+import pytest
+from application.instances import db, cache
+from application.models import User, Products, Orders, ItemsOrdered, Cart, Feedback
+from application.querybudget import QueryBudgetExceeded
+
+# (endpoint, user, url) of the requests checked, formatted with the sample data
+REQUESTS = [
+    ('search_products', 'customer', '/products/search?type=all&limit=100'),
+    ('search_products', 'customer', '/products/search?type=trending&limit=100'),
+    ('search_products', 'customer', '/products/search?type=latest&limit=100'),
+    ('product_reviews', 'customer', '/products/{product_id}/reviews?limit=100'),
+    ('category_products', 'customer', '/categories/{category_id}/products?limit=100'),
+    ('my_cart', 'customer', '/my-cart'),
+    ('track_orders', 'customer', '/track-orders/{customer_id}?limit=100'),
+    ('placed_orders', 'manager', '/manager/orders?limit=100'),
+    ('placed_orders', 'admin', '/manager/orders?limit=100'),
+    ('store_manager_order_items', 'manager', '/orders/{order_id}/items'),
+    ('store_manager_products', 'manager', '/manager/products'),
+]
+
+
+@pytest.fixture(scope='module')
+def sample(app):
+    with app.app_context():
+        # The customer with the most orders and the store manager with the most products
+        customer = db.session.get(User, db.session.query(Orders.customer_id).group_by(Orders.customer_id).order_by(db.func.count().desc()).limit(1).scalar())
+        manager = db.session.get(User, db.session.query(Products.store_owner_id).group_by(Products.store_owner_id).order_by(db.func.count().desc()).limit(1).scalar())
+        # The items of an order are only shown to the store manager who placed it
+        order_id = db.session.query(Orders.id).filter_by(customer_id=manager.id).limit(1).scalar()
+        if order_id is None:
+            order = Orders(customer_id=manager.id)
+            db.session.add(order)
+            db.session.flush()
+            db.session.add_all([ItemsOrdered(order_id=order.id, item_id=id, quantity=1, price_per_quantity=1) for id, in db.session.query(Products.id).limit(5)])
+            db.session.commit()
+            order_id = order.id
+        if not db.session.query(Cart.id).filter_by(customer_id=customer.id).count():
+            db.session.add_all([Cart(customer_id=customer.id, product_id=id, quantity=1) for id, in db.session.query(Products.id).limit(5)])
+            db.session.commit()
+        return {
+            'customer': customer.username, 'manager': manager.username, 'admin': User.query.filter_by(role_id=3).first().username,
+            'customer_id': customer.id, 'order_id': order_id,
+            'category_id': db.session.query(Products.category_id).group_by(Products.category_id).order_by(db.func.count().desc()).limit(1).scalar(),
+            # A reviewed product, so its reviews are really read
+            'product_id': db.session.query(Feedback.product_id).limit(1).scalar(),
+        }
+
+
+def test_every_budget_is_checked(app):
+    budgeted = {endpoint for endpoint, view in app.view_functions.items() if hasattr(view, 'query_budget')}
+    assert budgeted - {endpoint for endpoint, _, _ in REQUESTS} == set()
+
+@pytest.mark.parametrize('endpoint, user, url', REQUESTS)
+def test_query_budget(app, client, auth, sample, endpoint, user, url):
+    url = url.format(**sample)
+    headers = auth(sample[user])
+    with app.app_context():
+        cache.clear()
+    try:
+        response = client.get(url, headers=headers)
+    except QueryBudgetExceeded as e:
+        pytest.fail(f'{url} as {user}: {e}')
+    assert response.status_code == 200, f'{url} as {user}: {response.status_code}'
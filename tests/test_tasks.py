@@ -0,0 +1,10 @@
+from application.instances import db
+from application.models import Orders
+from application.tasks import sendMonthlyReports
+
+
+def test_monthly_reports_count_the_customers_without_orders_as_skipped(app):
+    with app.app_context():
+        missing = db.session.query(db.func.max(Orders.customer_id)).scalar() + 1
+        summary = sendMonthlyReports([missing, missing + 1], '2000-01-01', 'January')
+    assert summary == {'sent': 0, 'skipped': 2, 'failed': 0}
@@ -0,0 +1,19 @@
+echo "======================================================================"
+echo "Welcome to the local export workers setup for My Basket App"
+echo "This will setup the celery workers of the export queue."
+echo "Workers will be listening for export tasks to be run."
+echo "======================================================================"
+
+if [ -d "env" ];
+then
+   echo "Enabling virtual env"
+else
+   echo "No Virtual env. Please run tools.sh first"
+   exit N
+fi
+
+# Activate virtual env
+. env/bin/activate
+export ENV=LocalDevelopmentConfig
+celery -A main:celery worker --loglevel=info -Q exports -n exports@%h --concurrency 2
+deactivate
@@ -15,5 +15,5 @@ fi
 # Activate virtual env
 . env/bin/activate
 export ENV=LocalDevelopmentConfig
-celery -A main:celery worker --loglevel=info -P gevent
+celery -A main:celery worker --loglevel=info -P gevent -Q celery,mail
 deactivate